@@ -1,8 +1,15 @@
 import numpy as np
-from math import log2, pow
+from math import log10, log2, pow
+from metering import Meter
+
+
+# The brightness targets are given for 8-bit frames. 16-bit frames are metered in the same units.
+def brightness_scale(img):
+    return 1 if img.dtype == np.uint8 else 255.0 / np.iinfo(img.dtype).max
+
 
 class AutoExposurer:
-    def __init__(self, maxGain, maxExp):
+    def __init__(self, maxGain, maxExp, meter=None):
         self.maxGain = maxGain
         self.maxExp = maxExp
         self.skipFrames = 0  # Introduce some latency in exposure adjustment
@@ -10,13 +17,17 @@ class AutoExposurer:
         self.targetBrightnessLow = 100
         self.targetBrightnessHigh = 160
         self.targetBrightness = (self.targetBrightnessHigh + self.targetBrightnessLow) / 2
+        self.meter = meter if meter is not None else Meter()
+        self.histogram = None  # Histogram of the last frame, for other stages to reuse
 
     # Returns (changed, newGain, newExp, med)
     def adjustExp(self, gain, exp, img):
+        self.histogram = self.meter.measure(img)
+        scale = brightness_scale(img)
+        med = self.histogram.median * scale
         if self.skipFrames > 0:
             self.skipFrames -= 1
-            return (False, None, None, 100)
-        med = np.median(img)
+            return (False, None, None, med)
         if self.targetBrightnessLow < med < self.targetBrightnessHigh:
             return (False, None, None, med)
         # Need to adjust exposure. Add a latency to give the camera some responding time.
@@ -41,3 +52,86 @@ class AutoExposurer:
             newGain = min(self.maxGain, gainDelta + gain)
             return (True, int(newGain), int(self.maxExp), med)
 
+
+# Model based auto exposure.
+# Brightness is modelled as linear in exposure * 10^(gain / 200), since ZWO gain is in units of 0.1 dB.
+# From one frame we estimate the scene brightness per unit of exposure, and jump straight to the settings
+# that hit the target, preferring exposure over gain to keep the noise down.
+class PredictiveAutoExposurer:
+    def __init__(self, maxGain, maxExp, meter=None, minExp=32, sensorLatency=1):
+        self.maxGain = maxGain
+        self.maxExp = maxExp
+        self.minExp = minExp
+        # Frames the sensor still delivers with the old settings after the new ones are in effect.
+        # Frames captured before the new settings are in effect are recognized by the settings they carry.
+        self.sensorLatency = sensorLatency
+        self.maxSkipFrames = 10  # In case the camera rounds the values and they never match exactly
+        self.targetBrightnessLow = 100
+        self.targetBrightnessHigh = 160
+        self.targetBrightness = (self.targetBrightnessHigh + self.targetBrightnessLow) / 2
+        self.blackLevel = 0
+        # Above/below these the model is unreliable since the frame is clipped, so take a fixed large step
+        self.saturatedBrightness = 250
+        self.maxStepClipped = 16.0
+        # Damping reduces the step after the error changes sign, to stop oscillation
+        self.damping = 1.0
+        self.minDamping = 0.25
+        self.lastErrorSign = 0
+        self.pending = None
+        self.skipFrames = 0
+        self.skippedFrames = 0
+        self.meter = meter if meter is not None else Meter()
+        self.histogram = None  # Histogram of the last frame, for other stages to reuse
+
+    @staticmethod
+    def exposure_value(gain, exp):
+        return exp * pow(10, gain / 200)
+
+    # Splits an exposure value into (gain, exp), using gain only once exposure is maxed out
+    def split(self, ev):
+        if ev <= self.maxExp:
+            return (0, int(max(self.minExp, ev)))
+        gain = min(self.maxGain, 200 * log10(ev / self.maxExp))
+        return (int(round(gain)), int(self.maxExp))
+
+    # Returns (changed, newGain, newExp, med)
+    def adjustExp(self, gain, exp, img):
+        self.histogram = self.meter.measure(img)
+        scale = brightness_scale(img)
+        med = self.histogram.median * scale
+        if self.pending is not None:
+            # Skip the frames that were still in flight when the settings changed
+            self.skippedFrames += 1
+            if (gain, exp) != self.pending and self.skippedFrames < self.maxSkipFrames:
+                return (False, None, None, med)
+            self.pending = None
+            self.skipFrames = self.sensorLatency
+        if self.skipFrames > 0:
+            self.skipFrames -= 1
+            return (False, None, None, med)
+        if self.targetBrightnessLow < med < self.targetBrightnessHigh:
+            self.damping = min(1.0, self.damping * 2)
+            self.lastErrorSign = 0
+            return (False, None, None, med)
+        errorSign = 1 if med < self.targetBrightness else -1
+        if self.lastErrorSign == -errorSign:
+            # Overshot the target last time
+            self.damping = max(self.minDamping, self.damping / 2)
+        self.lastErrorSign = errorSign
+        if med >= self.saturatedBrightness:
+            # The true brightness could be anything above the clipping point
+            ratio = 1 / self.maxStepClipped
+        elif med <= 1:
+            # Near black the mean still carries some signal below one DN
+            signal = max(0.5, self.histogram.mean * scale - self.blackLevel)
+            ratio = min(self.maxStepClipped, (self.targetBrightness - self.blackLevel) / signal)
+        else:
+            ratio = (self.targetBrightness - self.blackLevel) / max(0.5, med - self.blackLevel)
+        ev = self.exposure_value(gain, exp)
+        newGain, newExp = self.split(ev * pow(ratio, self.damping))
+        if (newGain, newExp) == (gain, exp):
+            # At the limits of the camera
+            return (False, None, None, med)
+        self.pending = (newGain, newExp)
+        self.skippedFrames = 0
+        return (True, newGain, newExp, med)
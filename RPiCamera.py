@@ -6,22 +6,27 @@ from io import BytesIO
 from time import sleep, time
 from datetime import datetime
 from PIL import Image, ImageDraw, ImageFont
+from metrics import RateMeter, clock
+from pipeline import Frame
+import numpy as np
 
 
 # The worker thread that does the heavy lifting
 # Thsi sis fro Raspberry Pi's camera
 class RPiCamera(Thread):
-    def __init__(self, output_stream, latest_stream, logger, interval=0):
+    def __init__(self, broker, logger, interval=0):
         super(RPiCamera, self).__init__()
         self.terminate = False
         self.interval = interval
-        self.server = None # Optional hook for updating the watchdog, which monitors when the last frame was updated
         self.logger = logger
         self.initialize_camera()
 
         self.logger.info('Camera initialization complete.')
-        self.stream = output_stream
-        self.latest_stream = latest_stream
+        self.broker = broker
+        self.captureRate = RateMeter()
+        broker.metrics.register('capture_fps', 'gauge', 'Frames captured per second.', self.captureRate.rate)
+        broker.metrics.describe('frames_captured_total', 'Frames captured by the camera.')
+        broker.metrics.describe('capture_failures_total', 'Failed frame captures.')
         self.start()
 
     def initialize_camera(self):
@@ -69,24 +74,33 @@ class RPiCamera(Thread):
                     gain_n=self.camera.analog_gain.numerator,
                     gain_d=self.camera.analog_gain.denominator,
                     exposure=self.camera.exposure_speed))
+                metrics = self.broker.metrics
                 try:
                     buff.seek(0)
+                    start = clock()
                     self.camera.capture(buff, format='jpeg', quality=90)
-                    if self.server is not None:
-                        self.server.last_update_timestamp = time()
+                    metrics.observe_since('capture', start)
+                    self.broker.lastUpdate = time()
                 except Exception as e:
                     self.logger.error(e)
+                    metrics.count('capture_failures_total')
                     self.camera.close()
                     self.initialize_camera()
                     continue
+                metrics.count('frames_captured_total')
+                self.captureRate.tick()
                 buff.seek(0)
                 image = Image.open(buff)
                 # Add some annotation
+                start = clock()
                 draw = ImageDraw.Draw(image)
                 pstring = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
                 draw.text((15, 15), pstring, fill='black')
-                # Write to the stream
-                image.save(self.stream, format='jpeg', quality=90)
-                image.save(self.latest_stream, format='jpeg', quality=90)
+                metrics.observe_since('annotate', start)
+                # Publish to the broker, which encodes the variants that are in demand
+                frame = Frame(None, None, np.asarray(image), None, None)
+                frame.bgr = False
+                self.broker.publish_frame(frame)
+                frame.release()
         finally:
             self.camera.close()
@@ -1,103 +1,195 @@
-from threading import Condition, Thread
+from threading import Condition, Lock, Thread
 from os import system
-from time import sleep, time
+from time import monotonic, sleep, time
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont, ImageStat
-from AutoExposure import AutoExposurer
+from AutoExposure import PredictiveAutoExposurer
+from metrics import RateMeter, clock
+from pipeline import DropOldestQueue, FramePool, Frame
+from processing import TextOverlay
+from raw import BAYER_PATTERNS
+from tonemap import ToneMapper
 import numpy as np
-import zwoasi as asi
 
 # Set this according to your device
 SDK_PATH = 'ASI_linux_mac_SDK_V1.20/lib/armv7/libASICamera2.so'
-asi.init(SDK_PATH)
+sdk_lock = Lock()
+# Restored when the camera is reopened after a failure
+SNAPSHOT_CONTROLS = ('Exposure', 'Gain', 'WB_R', 'WB_B', 'BandWidth', 'Flip')
+zwoasi = None
+
+
+# The zwoasi module, with the SDK library loaded on first use rather than on import
+def load_sdk():
+    global zwoasi
+    with sdk_lock:
+        if zwoasi is None:
+            import zwoasi as asi
+            asi.init(SDK_PATH)
+            zwoasi = asi
+    return zwoasi
 
 
 # The worker thread that does the heavy lifting
 class ZWOCamera(Thread):
-    def __init__(self, output_stream, latest_stream, logger, interval=0):
-        super(ZWOCamera, self).__init__()
+    # sdk provides the zwoasi API, e.g. a simulator.SimulatedSDK to run without a camera. The real SDK by default.
+    # cameraId selects the camera, by its index or by its name as listed by the SDK.
+    # rawProcessor is given here rather than set afterwards, so that it develops the first frames as well.
+    def __init__(self, broker, logger, interval=0, encoderPool=None, sdk=None, imageType=None, cameraId=0, rawProcessor=None):
+        super(ZWOCamera, self).__init__(name='ZWOCamera-{}'.format(cameraId))
+        self.asi = sdk if sdk is not None else load_sdk()
+        self.cameraId = cameraId
+        self.imageType = imageType if imageType is not None else self.asi.ASI_IMG_RAW8
         self.terminate = False
         self.interval = interval
         self.last_gain = 0
         self.last_exposure = 0
-        self.server = None # Optional hook for updating the watchdog, which monitors when the last frame was updated
         self.logger = logger
-        self.continuousFailureCount = 0
-        self.maxContinuousFailureCount = 5
+        # Captures that keep failing escalate through these recovery tiers, each tried a number of times
+        # with an exponential backoff, from retrying the frame up to a full reinitialization of the camera.
+        self.recoveryTiers = [('retry', 2), ('restart', 2), ('reopen', 3), ('reinitialize', 2)]
+        self.minBackoff = 0.01  # Seconds
+        self.maxBackoff = 2
+        self.rebootOnFailure = True  # Reboot once every tier failed, otherwise keep reinitializing
+        self.recoveryStart = None  # When the current run of failures started
+        self.recoveryFailures = 0
+        self.recoveryTier = None
+        self.controlSnapshot = {}  # Control values of the last good frame, restored when the camera is reopened
+        self.autoControls = {}  # Whether each control is in auto mode
+        # Capture, process and encode run as separate stages, joined by bounded queues.
+        # A stage that falls behind drops its oldest pending frame instead of stalling the camera.
+        self.queueSize = 2
+        self.encoderPool = encoderPool  # Optional EncoderPool to encode in worker processes
+        self.motionDetector = None  # Optional MotionDetector, run on the raw frames
+        self.stacker = None  # Optional Stacker, publishes the average of the last frames instead of each frame
+        self.rawProcessor = rawProcessor  # Optional RawProcessor, bins and debayers the raw frames before the other stages
+        self.bayerPattern = None  # Of the raw frames, None for mono cameras
+        self.pool = None
+        self.pending_controls = None
+        self.controls_lock = Lock()
+        self.process_queue = DropOldestQueue(self.queueSize, on_drop=Frame.release)
+        self.encode_queue = DropOldestQueue(self.queueSize, on_drop=Frame.release)
+        self.processor = Thread(target=self.process_loop, daemon=True)
+        self.encoder = Thread(target=self.encode_loop, daemon=True)
         self.initialize_camera()
 
         # auto stretch
         self.auto_stretch = True
         self.auto_stretch_threshold = 40
         self.auto_stretch_target = 150
+        # One of 'gamma', 'asinh' or 'mtf'
+        self.auto_stretch_curve = 'gamma'
+        self.toneMapper = ToneMapper()
+        self.overlay = TextOverlay((15, 15))
 
         self.logger.info('Camera initialization complete.')
-        self.stream = output_stream
-        self.latest_stream = latest_stream
+        self.broker = broker
+        self.captureRate = RateMeter()
+        metrics = broker.metrics
+        metrics.register('capture_fps', 'gauge', 'Frames captured per second.', self.captureRate.rate)
+        metrics.register('dropped_frames_total', 'counter', 'Frames dropped by stages that fell behind.',
+                         lambda: self.process_queue.dropped + self.encode_queue.dropped)
+        metrics.describe('frames_captured_total', 'Frames captured by the camera.')
+        metrics.describe('capture_failures_total', 'Failed frame captures.')
+        metrics.describe('recoveries_total', 'Times the camera recovered from failed captures.')
         self.start()
 
     def initialize_camera(self):
         self.logger.info('Initializing camera...')
         sleep(2)
-        num_cameras = asi.get_num_cameras()
+        num_cameras = self.asi.get_num_cameras()
         if num_cameras == 0:
             raise RuntimeError('No ZWO camera was detected.')
-        try:
-            cameras_found = asi.list_cameras()
-            self.camera = asi.Camera(0)
-        except Exception as e:
-            # When the power is stable, this case is usually not recoverable except restart
-            self.logger.error(e)
-            self.logger.error("About to retry once")
-            try:
-                self.camera = asi.Camera(0)
-            except Exception as e:
-                self.logger.error(e)
-                self.logger.error("Still failed. About to restart in 60 seconds.")
-                sleep(60)
-                self.logger.error("About to restart now.")
-                system("reboot now")
+        # Raises when the camera can't be opened, recover() decides whether to try again or reboot
+        self.camera = self.asi.Camera(self.camera_index())
 
         # Uncomment to use binning
         #self.camera.set_roi(bins=4)
         camera_info = self.camera.get_camera_property()
         self.logger.info(camera_info)
+        if camera_info['IsColorCam'] and self.imageType in (self.asi.ASI_IMG_RAW8, self.asi.ASI_IMG_RAW16):
+            self.bayerPattern = BAYER_PATTERNS[camera_info['BayerPattern']]
+        else:
+            self.bayerPattern = None
         controls = self.camera.get_controls()
         self.logger.info(controls)
+        self.controls = controls
 
-        self.camera.set_image_type(asi.ASI_IMG_RAW8)
+        self.camera.set_image_type(self.imageType)
 
-        self.camera.set_control_value(asi.ASI_BANDWIDTHOVERLOAD, 
+        self.camera.set_control_value(self.asi.ASI_BANDWIDTHOVERLOAD, 
                                 self.camera.get_controls()['BandWidth']['DefaultValue'],
                                 auto=True)
 
         # Set auto exposure value
         self.whbi = self.camera.get_roi_format()
+        self.allocate_buffers()
         self.camera.auto_wb()
         # Uncomment to enable manual white balance
-        # self.camera.set_control_value(asi.ASI_WB_B, 99)
-        # self.camera.set_control_value(asi.ASI_WB_R, 75)
+        # self.camera.set_control_value(self.asi.ASI_WB_B, 99)
+        # self.camera.set_control_value(self.asi.ASI_WB_R, 75)
         # Uncomment to use stock auto exposure
         #self.useStockAutoExposure = True
-        #self.camera.set_control_value(asi.ASI_AUTO_MAX_GAIN, 425)
-        #self.camera.set_control_value(asi.ASI_AUTO_MAX_BRIGHTNESS, 130)
+        #self.camera.set_control_value(self.asi.ASI_AUTO_MAX_GAIN, 425)
+        #self.camera.set_control_value(self.asi.ASI_AUTO_MAX_BRIGHTNESS, 130)
         #self.camera.set_control_value(controls['AutoExpMaxExpMS']['ControlType'], 3000)
         # Use our own auto exposure
         self.useStockAutoExposure = False
         maxGain = controls['Gain']['MaxValue']
-        self.autoExposurer = AutoExposurer(maxGain, 500000) # us
-        self.camera.set_control_value(asi.ASI_EXPOSURE,
+        self.autoExposurer = PredictiveAutoExposurer(maxGain, 500000) # us
+        # Uncomment to use the step based auto exposure
+        # from AutoExposure import AutoExposurer
+        # self.autoExposurer = AutoExposurer(maxGain, 500000) # us
+        # Uncomment to meter only the sky of an all-sky camera, ignoring the horizon
+        # from metering import Meter, circle_mask
+        # self.autoExposurer.meter = Meter(mode='roi', mask=circle_mask((self.whbi[1], self.whbi[0]), 0.45))
+        # Uncomment to use center weighted metering
+        # from metering import Meter
+        # self.autoExposurer.meter = Meter(mode='center')
+        self.camera.set_control_value(self.asi.ASI_EXPOSURE,
                                  1000,
                                  auto=self.useStockAutoExposure)
-        self.camera.set_control_value(asi.ASI_GAIN,
+        self.camera.set_control_value(self.asi.ASI_GAIN,
                                  0,
                                  auto=self.useStockAutoExposure)
         # Uncomment to enable flip
-        # self.camera.set_control_value(asi.ASI_FLIP, 3)
+        # self.camera.set_control_value(self.asi.ASI_FLIP, 3)
+        self.autoControls = {name: self.camera.get_control_value(controls[name]['ControlType'])[1]
+                             for name in SNAPSHOT_CONTROLS if name in controls}
         self.camera.start_video_capture()
 
+    # Cameras selected by name are looked up on every open, since the indices change when cameras are replugged
+    def camera_index(self):
+        if isinstance(self.cameraId, int):
+            return self.cameraId
+        cameras_found = self.asi.list_cameras()
+        if cameras_found.count(self.cameraId) > 1:
+            # Cameras of the same model share the name, and would all open the first one
+            raise RuntimeError('There are {} ZWO cameras named {}, select them by index instead.'.format(
+                cameras_found.count(self.cameraId), self.cameraId))
+        if self.cameraId in cameras_found:
+            return cameras_found.index(self.cameraId)
+        if self.cameraId.isdigit():
+            return int(self.cameraId)
+        raise RuntimeError('ZWO camera {} was not found in {}.'.format(self.cameraId, cameras_found))
+
+    # Preallocate the frame buffers for the current ROI format.
+    # Enough buffers to fill every queue plus the one held by each stage and the broker, so capture never has to wait.
+    def allocate_buffers(self):
+        width, height, _, image_type = self.whbi
+        bytes_per_pixel = {self.asi.ASI_IMG_RAW8: 1, self.asi.ASI_IMG_Y8: 1, self.asi.ASI_IMG_RAW16: 2, self.asi.ASI_IMG_RGB24: 3}[image_type]
+        size = width * height * bytes_per_pixel
+        if self.pool is not None and self.pool.size == size:
+            return
+        # Frames still in flight are returned to the pool they came from
+        count = 2 * self.queueSize + 5
+        if self.encoderPool is not None:
+            count += len(self.encoderPool.slots)
+        self.pool = FramePool(size, count)
+
     def run(self):
         self.logger.info('Start capturing...')
+        self.processor.start()
+        self.encoder.start()
         last_timestamp = 0
         try:
             while not self.terminate:
@@ -105,76 +197,235 @@ class ZWOCamera(Thread):
                     sleep(0.1)
                     continue
                 last_timestamp = time()
-                # self.logger.debug('About to take photo.')
-                settings = self.camera.get_control_values()
+                metrics = self.broker.metrics
+                try:
+                    start = clock()
+                    self.apply_pending_controls()
+                    # self.logger.debug('About to take photo.')
+                    settings = self.camera.get_control_values()
+                    metrics.observe_since('control', start)
+                except Exception as e:
+                    self.recover(e)
+                    continue
                 self.last_gain = settings['Gain']
                 self.last_exposure = settings['Exposure']
+                buffer = self.pool.acquire(timeout=1)
+                if buffer is None:
+                    self.logger.warning('No free frame buffer, all of them are still in the pipeline.')
+                    continue
                 try:
-                    img = self.camera.capture_video_frame(timeout=max(5000, 500 + 10 * settings['Exposure'] / 1000))
-                    if self.server is not None:
-                        self.server.last_update_timestamp = time()
+                    start = clock()
+                    img = self.camera.capture_video_frame(buffer_=buffer, timeout=max(5000, 500 + 10 * settings['Exposure'] / 1000))
+                    metrics.observe_since('capture', start)
+                    self.broker.lastUpdate = time()
                 except Exception as e:
-                    self.logger.error(e)
-                    self.continuousFailureCount += 1
-                    if self.continuousFailureCount >= self.maxContinuousFailureCount:
-                        self.logger.error("Max continuous failure count reached.. About to restart in 60 seconds.")
-                        sleep(60)
-                        self.logger.error("About to restart now.")
-                        system("reboot now")
-                    self.camera.stop_exposure()
-                    self.camera.stop_video_capture()
-                    self.camera.close()
-                    self.initialize_camera()
-                    # Set the exposure and gain to the last known good value to reduce the auto exposure time
-                    self.camera.set_control_value(asi.ASI_EXPOSURE,
-                                             self.last_exposure,
-                                             auto=self.useStockAutoExposure)
-                    self.camera.set_control_value(asi.ASI_GAIN,
-                                             self.last_gain,
-                                             auto=self.useStockAutoExposure)
+                    self.pool.release(buffer)
+                    self.recover(e)
                     continue
-                self.continuousFailureCount = 0
-                # Update the auto exposure
-                result = self.autoExposurer.adjustExp(self.last_gain, self.last_exposure, img)
-                if result is None:
-                    # For unknown reason, sometimes the result would be None. Simply retry would solve the issue
-                    result = self.autoExposurer.adjustExp(self.last_gain, self.last_exposure, img)
-                    if result is None:
-                        continue
-                changed, newGain, newExp, med = result
-                if changed:
-                    self.camera.set_control_value(asi.ASI_EXPOSURE,
-                        newExp,
-                        auto=self.useStockAutoExposure)
-                    self.camera.set_control_value(asi.ASI_GAIN,
-                        newGain,
-                        auto=self.useStockAutoExposure)
-                    self.logger.debug(f'Changed {changed} Med: {med} Gain: {newGain} Exposure: {newExp}')
-                else:
-                    self.logger.debug(f'Changed {changed} Med: {med} Gain: {self.last_gain} Exposure: {self.last_exposure}')
-                # convert the numpy array to PIL image
-                mode = None
-                if len(img.shape) == 3:
-                    img = img[:, :, ::-1]  # Convert BGR to RGB
-                if self.whbi[3] == asi.ASI_IMG_RAW16:
-                    mode = 'I;16'
-                image = Image.fromarray(img, mode=mode)
-                # If the image is too dark, auto stretch it
-                stat = ImageStat.Stat(image)
-                mean = stat.mean[0]
-                if self.auto_stretch and mean < self.auto_stretch_threshold:
-                    # apply a gamma transform
-                    gamma = np.log(self.auto_stretch_target) / np.log(mean)
-                    arr = np.asarray(image)
-                    arr = np.minimum(255, np.power(arr, gamma)).astype('uint8')
-                    image = Image.fromarray(arr, mode=image.mode)
-                # Add some annotation
-                draw = ImageDraw.Draw(image)
-                pstring = datetime.now().strftime("%m/%d/%Y, %H:%M:%S") + f', gain {self.last_gain}, exp {self.last_exposure}'
-                draw.text((15, 15), pstring, fill='white')
-                # Write to the stream
-                image.save(self.stream, format='jpeg', quality=90)
-                image.save(self.latest_stream, format='jpeg', quality=90)
+                self.controlSnapshot = settings
+                if self.recoveryStart is not None:
+                    self.recovered()
+                metrics.count('frames_captured_total')
+                self.captureRate.tick()
+                self.process_queue.put(Frame(self.pool, buffer, img, self.last_gain, self.last_exposure))
         finally:
+            self.terminate = True
             self.camera.stop_video_capture()
             self.camera.stop_exposure()
+
+    # Escalates through the recovery tiers while captures keep failing, after a backoff that doubles
+    # with every failure in the same tier. Only once every tier failed the Pi is rebooted.
+    def recover(self, error):
+        self.logger.error(error)
+        metrics = self.broker.metrics
+        metrics.count('capture_failures_total')
+        if self.recoveryStart is None:
+            self.recoveryStart = monotonic()
+            self.recoveryFailures = 0
+        failures = self.recoveryFailures
+        self.recoveryFailures += 1
+        for tier, attempts in self.recoveryTiers:
+            if failures < attempts:
+                break
+            failures -= attempts
+        else:
+            if self.rebootOnFailure:
+                self.logger.error("Every recovery failed. About to restart in 60 seconds.")
+                sleep(60)
+                self.logger.error("About to restart now.")
+                system("reboot now")
+            tier, attempts = self.recoveryTiers[-1]
+            failures = attempts - 1
+        sleep(min(self.maxBackoff, self.minBackoff * 2 ** failures))
+        self.recoveryTier = tier
+        self.logger.warning('Recovering the camera: {} (attempt {}).'.format(tier, failures + 1))
+        try:
+            if tier == 'restart':
+                self.restart_capture()
+            elif tier == 'reopen':
+                self.reopen_camera()
+            elif tier == 'reinitialize':
+                self.reinitialize_camera()
+        except Exception as e:
+            # The next capture fails as well and escalates further
+            self.logger.error(e)
+
+    # Time to the first good frame since the failures started
+    def recovered(self):
+        elapsed = monotonic() - self.recoveryStart
+        self.logger.info('Camera recovered by {} after {} failures, first frame after {:.0f} ms.'.format(
+            self.recoveryTier or 'retry', self.recoveryFailures, elapsed * 1000))
+        self.broker.metrics.observe('recovery', elapsed)
+        self.broker.metrics.count('recoveries_total')
+        self.recoveryStart = None
+        self.recoveryTier = None
+
+    # Restarts video capture on the same camera handle
+    def restart_capture(self):
+        self.camera.stop_video_capture()
+        self.camera.start_video_capture()
+
+    # Opens the camera again and restores the ROI and controls of the last good frame, without reading
+    # every property or waiting for the camera to settle
+    def reopen_camera(self):
+        try:
+            self.camera.stop_video_capture()
+            self.camera.close()
+        except Exception as e:
+            self.logger.warning(e)
+        self.camera = self.asi.Camera(self.camera_index())
+        width, height, bins, image_type = self.whbi
+        self.camera.set_roi(width=width, height=height, bins=bins, image_type=image_type)
+        for name, value in self.controlSnapshot.items():
+            if name in self.autoControls:
+                self.camera.set_control_value(self.controls[name]['ControlType'], value, auto=self.autoControls[name])
+        self.camera.start_video_capture()
+
+    # The last resort before a reboot, which enumerates and sets up the camera from scratch
+    def reinitialize_camera(self):
+        try:
+            self.camera.stop_exposure()
+            self.camera.stop_video_capture()
+            self.camera.close()
+        except Exception as e:
+            self.logger.warning(e)
+        self.initialize_camera()
+        # Set the exposure and gain to the last known good value to reduce the auto exposure time
+        self.camera.set_control_value(self.asi.ASI_EXPOSURE,
+                                 self.last_exposure,
+                                 auto=self.useStockAutoExposure)
+        self.camera.set_control_value(self.asi.ASI_GAIN,
+                                 self.last_gain,
+                                 auto=self.useStockAutoExposure)
+
+    # Control values are only touched from the capture thread. The process stage leaves its decision here.
+    def apply_pending_controls(self):
+        with self.controls_lock:
+            pending, self.pending_controls = self.pending_controls, None
+        if pending is None:
+            return
+        newGain, newExp = pending
+        self.camera.set_control_value(self.asi.ASI_EXPOSURE,
+            newExp,
+            auto=self.useStockAutoExposure)
+        self.camera.set_control_value(self.asi.ASI_GAIN,
+            newGain,
+            auto=self.useStockAutoExposure)
+
+    def process_loop(self):
+        while not self.terminate:
+            frame = self.process_queue.get(timeout=0.5)
+            if frame is None:
+                continue
+            try:
+                if self.process_frame(frame):
+                    self.encode_queue.put(frame)
+                    continue
+            except Exception as e:
+                self.logger.error(e)
+            frame.release()
+
+    # Returns False if the frame should be dropped
+    def process_frame(self, frame):
+        metrics = self.broker.metrics
+        # Bin and debayer first, so that every later stage works on the developed frame
+        if self.rawProcessor is not None:
+            start = clock()
+            if not self.rawProcessor.develop(frame, self.bayerPattern):
+                return False
+            metrics.observe_since('develop', start)
+        img = frame.img
+        # Update the auto exposure
+        start = clock()
+        result = self.autoExposurer.adjustExp(frame.gain, frame.exposure, img)
+        if result is None:
+            # For unknown reason, sometimes the result would be None. Simply retry would solve the issue
+            result = self.autoExposurer.adjustExp(frame.gain, frame.exposure, img)
+            if result is None:
+                return False
+        metrics.observe_since('auto_exposure', start)
+        changed, newGain, newExp, med = result
+        if changed:
+            with self.controls_lock:
+                self.pending_controls = (newGain, newExp)
+            self.logger.debug(f'Changed {changed} Med: {med} Gain: {newGain} Exposure: {newExp}')
+        else:
+            self.logger.debug(f'Changed {changed} Med: {med} Gain: {frame.gain} Exposure: {frame.exposure}')
+        # Look for motion before the frame is stretched and annotated
+        event = None
+        if self.motionDetector is not None:
+            start = clock()
+            event = self.motionDetector.detect(frame)
+            metrics.observe_since('motion', start)
+        # Average the frames in low light. The stack restarts when something moves, and by itself
+        # when the auto exposure changed the gain or exposure.
+        if self.stacker is not None:
+            if event is not None:
+                self.stacker.reset()
+            start = clock()
+            self.stacker.stack(frame)
+            metrics.observe_since('stack', start)
+        # If the image is too dark, auto stretch it. Reuse the histogram from metering for the mean.
+        frame.histogram = self.autoExposurer.histogram
+        mean = frame.histogram.mean
+        # The thresholds are given for 8-bit images
+        scale = np.iinfo(img.dtype).max / 255
+        stretch = self.auto_stretch and mean < self.auto_stretch_threshold * scale
+        if self.rawProcessor is not None and self.rawProcessor.eightBit and img.dtype != np.uint8:
+            # Convert to 8 bits, with the stretch in the same LUT
+            start = clock()
+            lut = None
+            if stretch:
+                lut = self.toneMapper.stretch_lut(img.dtype, mean, self.auto_stretch_target * scale, self.auto_stretch_curve, np.uint8)
+            if not self.rawProcessor.to_eight_bit(frame, lut):
+                return False
+            img = frame.img
+            metrics.observe_since('stretch', start)
+        elif stretch:
+            # apply a tone curve through a cached LUT, in place on the frame buffer
+            start = clock()
+            self.toneMapper.stretch(img, mean, self.auto_stretch_target * scale, self.auto_stretch_curve)
+            metrics.observe_since('stretch', start)
+        # Add some annotation, in place on the frame buffer
+        start = clock()
+        pstring = datetime.fromtimestamp(frame.timestamp).strftime("%m/%d/%Y, %H:%M:%S") + f', gain {frame.gain}, exp {frame.exposure}'
+        self.overlay.draw(img, pstring)
+        metrics.observe_since('annotate', start)
+        return True
+
+    def encode_loop(self):
+        while not self.terminate:
+            frame = self.encode_queue.get(timeout=0.5)
+            if frame is None:
+                continue
+            try:
+                # Publish to the broker, which encodes the variants that are in demand
+                if self.encoderPool is not None:
+                    # Published by the pool once encoded
+                    self.encoderPool.submit(frame, self.broker)
+                else:
+                    self.broker.publish_frame(frame)
+            except Exception as e:
+                self.logger.error(e)
+            finally:
+                frame.release()
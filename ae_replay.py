@@ -0,0 +1,120 @@
+# Replays scene brightness traces through the auto exposure controllers offline,
+# and reports how many frames each one needs to converge after the scene changes.
+#
+# A trace file has one scene brightness per line, in DN per us of exposure at gain 0.
+# A CSV log with med,gain,exposure columns (as logged by ZWOCamera) also works, the scene brightness is derived from it.
+# Without trace files, a few synthetic traces are used (dusk, lights switching on and off).
+#
+# Usage: python3 ae_replay.py [--latency N] [--sensor-latency N] [trace ...]
+from math import exp, log
+import argparse
+import csv
+import json
+import random
+import numpy as np
+from AutoExposure import AutoExposurer, PredictiveAutoExposurer
+
+CONTROLLERS = {
+    'step': AutoExposurer,
+    'predictive': PredictiveAutoExposurer,
+}
+
+
+def load_trace(fn):
+    with open(fn) as f:
+        rows = [row for row in csv.reader(f) if row and not row[0].startswith('#')]
+    if rows and not rows[0][0].replace('.', '', 1).replace('e-', '', 1).isdigit():
+        header = [h.strip().lower() for h in rows[0]]
+        med, gain, exposure = header.index('med'), header.index('gain'), header.index('exposure')
+        return [float(r[med]) / PredictiveAutoExposurer.exposure_value(float(r[gain]), float(r[exposure])) for r in rows[1:]]
+    return [float(r[0]) for r in rows]
+
+
+def synthetic_traces():
+    # Scene brightness that hits the target at about 1 ms exposure
+    day = 130 / 1000
+    return {
+        # Brightness drops 10000x over 20 minutes at 1 fps
+        'dusk': [day * exp(-log(10000) * i / 1200) for i in range(1400)],
+        # Lights switching on and off in a dark room
+        'lights': [day / 200] * 60 + [day * 2] * 60 + [day / 200] * 60 + [day / 20] * 60,
+    }
+
+
+# Simulates the camera in video mode. A decision made on frame i is applied before frame i + latency is captured,
+# and the sensor delivers sensorLatency more frames exposed with the old settings.
+def simulate(controller, trace, latency=2, sensorLatency=1, noise=0.02, seed=0):
+    rng = random.Random(seed)
+    gain, exposure = 0, 1000
+    exposed = [(gain, exposure)]
+    scheduled = {}
+    meds = []
+    errors = 0
+    for i, scene in enumerate(trace):
+        if i in scheduled:
+            gain, exposure = scheduled.pop(i)
+        exposed.append((gain, exposure))
+        exposedGain, exposedExp = exposed[max(0, len(exposed) - 1 - sensorLatency)]
+        brightness = scene * PredictiveAutoExposurer.exposure_value(exposedGain, exposedExp) * (1 + rng.gauss(0, noise))
+        img = np.full((8, 8), int(min(255, max(0, brightness))), np.uint8)
+        meds.append(int(img[0, 0]))
+        try:
+            result = controller.adjustExp(gain, exposure, img)
+        except Exception:
+            # e.g. the step controller can't handle a black frame
+            errors += 1
+            continue
+        if result is not None and result[0]:
+            scheduled[i + latency] = (int(result[1]), int(result[2]))
+    return meds, errors
+
+
+# Frames from each scene change until the brightness is within the target range for settle frames in a row
+def convergence(trace, meds, low, high, settle=3, threshold=1.25):
+    events = [0] + [i for i in range(1, len(trace)) if max(trace[i], trace[i - 1]) / max(1e-12, min(trace[i], trace[i - 1])) > threshold]
+    results = []
+    for n, start in enumerate(events):
+        end = events[n + 1] if n + 1 < len(events) else len(trace)
+        frames = None
+        inRange = 0
+        for i in range(start, end):
+            inRange = inRange + 1 if low < meds[i] < high else 0
+            if inRange >= settle:
+                frames = i - start - settle + 1
+                break
+        results.append({'frame': start, 'frames_to_convergence': frames})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay brightness traces through the auto exposure controllers.')
+    parser.add_argument('traces', nargs='*')
+    parser.add_argument('--latency', type=int, default=2, help='frames until a new setting is applied')
+    parser.add_argument('--sensor-latency', type=int, default=1, help='frames the sensor lags behind the settings')
+    parser.add_argument('--max-gain', type=int, default=510)
+    parser.add_argument('--max-exp', type=int, default=500000)
+    args = parser.parse_args()
+    traces = {fn: load_trace(fn) for fn in args.traces} if args.traces else synthetic_traces()
+    report = {}
+    for traceName, trace in traces.items():
+        report[traceName] = {}
+        for name, cls in CONTROLLERS.items():
+            controller = cls(args.max_gain, args.max_exp)
+            if isinstance(controller, PredictiveAutoExposurer):
+                controller.sensorLatency = args.sensor_latency
+            meds, errors = simulate(controller, trace, args.latency, args.sensor_latency)
+            events = convergence(trace, meds, controller.targetBrightnessLow, controller.targetBrightnessHigh)
+            converged = [e['frames_to_convergence'] for e in events if e['frames_to_convergence'] is not None]
+            report[traceName][name] = {
+                'events': len(events),
+                'converged': len(converged),
+                'mean_frames': sum(converged) / len(converged) if converged else None,
+                'max_frames': max(converged) if converged else None,
+                'errors': errors,
+                'in_range_fraction': sum(controller.targetBrightnessLow < m < controller.targetBrightnessHigh for m in meds) / len(meds),
+            }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
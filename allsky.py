@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+from threading import Lock
+import numpy as np
+from processing import downscale, encode_jpeg
+
+
+# Converts 16-bit frames to 8 bits, which is all the products keep
+def to_8bit(img):
+    if img.dtype == np.uint8:
+        return img
+    return (img >> 8).astype(np.uint8)
+
+
+# A keogram, built one column per frame from the centre column or the average of a slice of columns.
+# The columns go into a preallocated array. When it is full, every other column is dropped and
+# only every other frame is added from then on, so it covers any length of time in bounded memory.
+class Keogram(object):
+    def __init__(self, capacity=2048, columns=None):
+        self.capacity = capacity
+        self.columns = columns  # A slice of the frame columns, the centre column by default
+        self.image = None
+        self.timestamps = np.zeros(capacity)
+        self.count = 0
+        self.every = 1  # Adds every Nth frame
+        self.skipped = 0
+
+    def reset(self):
+        self.count = 0
+        self.every = 1
+        self.skipped = 0
+
+    def add(self, frame):
+        self.skipped += 1
+        if self.skipped < self.every:
+            return
+        self.skipped = 0
+        img = frame.img
+        if self.image is None or self.image.shape[0] != img.shape[0] or self.image.shape[2:] != img.shape[2:]:
+            self.image = np.zeros((img.shape[0], self.capacity) + img.shape[2:], np.uint8)
+            self.reset()
+        if self.count == self.capacity:
+            half = self.capacity // 2
+            self.image[:, :half] = self.image[:, 0:self.capacity:2]
+            self.timestamps[:half] = self.timestamps[0:self.capacity:2]
+            self.count = half
+            self.every *= 2
+        columns = self.columns if self.columns is not None else slice(img.shape[1] // 2, img.shape[1] // 2 + 1)
+        strip = img[:, columns]
+        if strip.shape[1] == 1:
+            self.image[:, self.count] = to_8bit(strip[:, 0])
+        else:
+            self.image[:, self.count] = to_8bit(strip.mean(axis=1, dtype=np.float32).astype(img.dtype))
+        self.timestamps[self.count] = frame.timestamp
+        self.count += 1
+
+    # A view of the columns added so far
+    def current(self):
+        return self.image[:, :self.count] if self.image is not None else None
+
+
+# Every Nth frame, downscaled and encoded once, as the frames of a time-lapse.
+# Like the keogram, it drops every other frame when it reaches capacity and halves its frame rate.
+class TimeLapse(object):
+    def __init__(self, every=30, factor=4, quality=80, capacity=1024):
+        self.initialEvery = every
+        self.every = every
+        self.factor = factor
+        self.quality = quality
+        self.capacity = capacity
+        self.frames = []  # (timestamp, JPEG data)
+        self.skipped = 0
+
+    def reset(self):
+        self.frames = []
+        self.every = self.initialEvery
+        self.skipped = 0
+
+    def add(self, frame):
+        self.skipped += 1
+        if self.skipped < self.every:
+            return
+        self.skipped = 0
+        if len(self.frames) == self.capacity:
+            self.frames = self.frames[::2]
+            self.every *= 2
+        img = to_8bit(downscale(frame.img, self.factor))
+        # Replaced instead of appended to, so readers can iterate over their own reference
+        self.frames = self.frames + [(frame.timestamp, bytes(encode_jpeg(img, self.quality, frame.bgr)))]
+
+
+# Builds the keogram and the time-lapse of the night as the frames are published, from the processed frames
+# and without decoding any JPEG. Both start over every day at resetHour, local time.
+class AllSkyProducts(object):
+    def __init__(self, broker, keogram=None, timelapse=None, resetHour=12):
+        self.keogram = keogram if keogram is not None else Keogram()
+        self.timelapse = timelapse if timelapse is not None else TimeLapse()
+        self.resetHour = resetHour
+        self.nextReset = self.next_reset(datetime.now().timestamp())
+        self.lock = Lock()
+        self.keogramJpeg = None
+        self.keogramKey = None
+        self.bgr = True
+        broker.listeners.append(self.on_frame)
+
+    def next_reset(self, timestamp):
+        now = datetime.fromtimestamp(timestamp)
+        reset = now.replace(hour=self.resetHour, minute=0, second=0, microsecond=0)
+        if reset <= now:
+            reset += timedelta(days=1)
+        return reset.timestamp()
+
+    # Called from the producer thread. A column per frame, and a small encode every Nth frame.
+    def on_frame(self, frame):
+        if frame.img is None:
+            return
+        with self.lock:
+            if frame.timestamp >= self.nextReset:
+                self.nextReset = self.next_reset(frame.timestamp)
+                self.keogram.reset()
+                self.timelapse.reset()
+            self.bgr = frame.bgr
+            self.keogram.add(frame)
+            self.timelapse.add(frame)
+
+    # The keogram so far as JPEG, encoded again only when it has grown. None before the first frame.
+    def keogram_jpeg(self, quality=90):
+        with self.lock:
+            key = (self.nextReset, self.keogram.count, self.keogram.every, quality)
+            if key == self.keogramKey:
+                return self.keogramJpeg
+            columns = self.keogram.current()
+            if columns is None or columns.shape[1] == 0:
+                return None
+            # Encoded from a copy, so the producer isn't kept waiting
+            columns = columns.copy()
+            bgr = self.bgr
+        data = bytes(encode_jpeg(columns, quality, bgr))
+        with self.lock:
+            self.keogramJpeg = data
+            self.keogramKey = key
+        return data
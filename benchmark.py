@@ -0,0 +1,232 @@
+# Runs the capture pipeline end to end on a simulated camera and reports how it performs, as JSON.
+#
+# It measures the latency from capture to publish, the sustained frame rate, the wall and CPU time spent in
+# each pipeline stage, the CPU time of the whole process, and the throughput of the streaming server
+# to a number of simulated MJPEG clients. Save the reports of two runs to compare them.
+#
+# Usage: python3 benchmark.py [--duration S] [--width W] [--height H] [--image-type raw8|raw16|rgb24]
+#                             [--fps N] [--failure-rate P] [--failure-burst N] [--replay PATH] [--clients N]
+#                             [--server threaded|async] [--encoders N] [--bins N] [--debayer] [--output FILE]
+from threading import Thread
+from time import monotonic, process_time, sleep, time
+import argparse
+import json
+import logging
+import platform
+import socket
+from metrics import BUCKETS
+from raw import RawProcessor
+from simulator import SimulatedSDK, load_frames
+from streaming import FrameBroker, StreamingServer, StreamingHandler, AsyncStreamingServer
+from ZWOCamera import ZWOCamera
+
+IMAGE_TYPES = {'raw8': SimulatedSDK.ASI_IMG_RAW8, 'raw16': SimulatedSDK.ASI_IMG_RAW16, 'rgb24': SimulatedSDK.ASI_IMG_RGB24}
+
+
+# Reads an MJPEG stream and counts the frames and bytes received, until stopped
+class StreamClient(Thread):
+    def __init__(self, address, path):
+        super(StreamClient, self).__init__(daemon=True)
+        self.address = address
+        self.path = path
+        self.frames = 0
+        self.bytes = 0
+        self.error = None
+        self.terminate = False
+
+    def run(self):
+        try:
+            with socket.create_connection(self.address, timeout=10) as sock:
+                sock.sendall('GET {} HTTP/1.0\r\n\r\n'.format(self.path).encode('latin-1'))
+                stream = sock.makefile('rb')
+                # Skip the response headers
+                while stream.readline() not in (b'\r\n', b''):
+                    pass
+                while not self.terminate:
+                    length = None
+                    while True:
+                        line = stream.readline()
+                        if not line:
+                            return
+                        if line == b'\r\n' and length is not None:
+                            break
+                        name, _, value = line.partition(b':')
+                        if name.strip().lower() == b'content-length':
+                            length = int(value)
+                    data = stream.read(length + 2)
+                    self.frames += 1
+                    self.bytes += len(data) - 2
+        except Exception as e:
+            self.error = str(e)
+
+
+# Latency of every published frame, from the capture timestamp
+class LatencyProbe(object):
+    def __init__(self):
+        self.latencies = []
+        self.recording = False
+
+    def on_frame(self, frame):
+        if self.recording:
+            self.latencies.append(time() - frame.timestamp)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def snapshot(metrics):
+    with metrics.lock:
+        timings = {stage: (list(t.counts), t.sum, t.count, t.cpuSum, t.cpuCount) for stage, t in metrics.timings.items()}
+        counters = dict(metrics.counters)
+    return timings, counters
+
+
+# The upper bound of the histogram bucket the p-th percentile falls into
+def bucket_percentile(counts, p):
+    total = sum(counts)
+    cumulative = 0
+    for bound, n in zip(BUCKETS + (float('inf'),), counts):
+        cumulative += n
+        if cumulative >= total * p / 100:
+            return bound
+    return None
+
+
+# Per stage timings observed between two snapshots. mean_ms is wall time, cpu_mean_ms the CPU time of the
+# thread that ran the stage, so e.g. the capture stage is mostly waiting for the exposure, not computing.
+def stage_report(before, after):
+    report = {}
+    for stage, (counts, total, count, cpuTotal, cpuCount) in sorted(after.items()):
+        oldCounts, oldTotal, oldCount, oldCpuTotal, oldCpuCount = before.get(stage, ([0] * len(counts), 0, 0, 0, 0))
+        counts = [n - old for n, old in zip(counts, oldCounts)]
+        count -= oldCount
+        cpuCount -= oldCpuCount
+        if count == 0:
+            continue
+        report[stage] = {
+            'count': count,
+            'mean_ms': (total - oldTotal) / count * 1000,
+            'cpu_mean_ms': (cpuTotal - oldCpuTotal) / cpuCount * 1000 if cpuCount else None,
+            'p50_ms_bound': bucket_percentile(counts, 50) * 1000,
+            'p95_ms_bound': bucket_percentile(counts, 95) * 1000,
+        }
+    return report
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the capture pipeline and streaming server on a simulated camera.')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to measure')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds to run before measuring')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--image-type', choices=sorted(IMAGE_TYPES), default='raw8')
+    parser.add_argument('--fps', type=float, default=30, help='frame rate of the simulated sensor')
+    parser.add_argument('--no-exposure-delay', action='store_true', help="don't wait for the exposure time")
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of the captures that fail')
+    parser.add_argument('--failure-burst', type=int, default=1, help='captures in a row that fail in each failure')
+    parser.add_argument('--replay', help='directory of images or recorder segments to replay')
+    parser.add_argument('--clients', type=int, default=4, help='simulated MJPEG clients')
+    parser.add_argument('--path', default='/stream.mjpg', help='stream the clients ask for')
+    parser.add_argument('--server', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--encoders', type=int, default=0, help='encoder worker processes, 0 to encode in the pipeline')
+    parser.add_argument('--bins', type=int, default=1, help='software binning of the raw frames')
+    parser.add_argument('--debayer', action='store_true', help='demosaic the raw frames into color')
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('benchmark')
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.WARNING)
+    imageType = IMAGE_TYPES[args.image_type]
+    replay = load_frames(args.replay, imageType) if args.replay else None
+    sdk = SimulatedSDK(args.width, args.height, imageType, args.fps, not args.no_exposure_delay, args.failure_rate,
+                       replay=replay, failureBurst=args.failure_burst)
+    broker = FrameBroker()
+    probe = LatencyProbe()
+    broker.listeners.append(probe.on_frame)
+    encoderPool = None
+    if args.encoders > 0:
+        from encoder_pool import EncoderPool
+        encoderPool = EncoderPool(broker, args.encoders, logger)
+    rawProcessor = RawProcessor(args.bins, args.debayer) if args.bins > 1 or args.debayer else None
+    camera = ZWOCamera(broker, logger, 0, encoderPool, sdk=sdk, imageType=imageType, rawProcessor=rawProcessor)
+    # Failures are expected here, never reboot the machine
+    camera.rebootOnFailure = False
+
+    address = ('127.0.0.1', free_port())
+    if args.server == 'async':
+        server = AsyncStreamingServer(address, broker)
+    else:
+        server = StreamingServer(address, StreamingHandler, broker)
+    Thread(target=server.serve_forever, daemon=True).start()
+    sleep(0.5)
+    clients = [StreamClient(address, args.path) for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    try:
+        sleep(args.warmup)
+        timings, counters = snapshot(broker.metrics)
+        dropped = camera.process_queue.dropped + camera.encode_queue.dropped
+        clientStart = [(client.frames, client.bytes) for client in clients]
+        seq = broker.seq
+        probe.recording = True
+        start, cpuStart = monotonic(), process_time()
+        sleep(args.duration)
+        probe.recording = False
+        elapsed, cpu = monotonic() - start, process_time() - cpuStart
+        newTimings, newCounters = snapshot(broker.metrics)
+        published = broker.seq - seq
+        captured = newCounters.get('frames_captured_total', 0) - counters.get('frames_captured_total', 0)
+        received = [(client.frames - frames, client.bytes - bytes_) for client, (frames, bytes_) in zip(clients, clientStart)]
+        report = {
+            'config': dict(vars(args), machine=platform.machine(), python=platform.python_version()),
+            'capture_fps': captured / elapsed,
+            'publish_fps': published / elapsed,
+            'capture_failures': newCounters.get('capture_failures_total', 0) - counters.get('capture_failures_total', 0),
+            'recoveries': newCounters.get('recoveries_total', 0) - counters.get('recoveries_total', 0),
+            'dropped_frames': camera.process_queue.dropped + camera.encode_queue.dropped - dropped,
+            'latency_ms': {
+                'mean': sum(probe.latencies) / len(probe.latencies) * 1000 if probe.latencies else None,
+                'p50': (percentile(probe.latencies, 50) or 0) * 1000,
+                'p95': (percentile(probe.latencies, 95) or 0) * 1000,
+                'max': max(probe.latencies, default=0) * 1000,
+            },
+            'stages': stage_report(timings, newTimings),
+            'cpu': {
+                'seconds': cpu,
+                'cores_used': cpu / elapsed,
+                'ms_per_frame': cpu / published * 1000 if published else None,
+            },
+            'server': {
+                'clients': len(clients),
+                'client_errors': [client.error for client in clients if client.error is not None],
+                'fps_per_client': [frames / elapsed for frames, _ in received],
+                'megabytes_per_second': sum(bytes_ for _, bytes_ in received) / elapsed / 1e6,
+            },
+        }
+    finally:
+        for client in clients:
+            client.terminate = True
+        camera.terminate = True
+        if encoderPool is not None:
+            encoderPool.close()
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
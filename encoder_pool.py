@@ -0,0 +1,217 @@
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from collections import deque
+from queue import Empty
+from threading import Condition, Thread
+from time import monotonic, thread_time
+import logging
+import numpy as np
+from processing import downscale, encode_jpeg
+
+
+def attach(name):
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching also registers the block with the resource tracker.
+        # The workers share the tracker of the pool, so that's harmless.
+        return SharedMemory(name=name)
+
+
+# Runs in the worker processes. Encodes the requested variants of the frame in a shared memory slot.
+def encode_worker(tasks, results):
+    attached = {}  # Slot -> SharedMemory
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job, slot, name, shape, dtype, bgr, variants = task
+        try:
+            start, cpu = monotonic(), thread_time()
+            shm = attached.get(slot)
+            if shm is None or shm.name != name:
+                # The slot was reallocated for larger frames, the old block is already unlinked
+                if shm is not None:
+                    shm.close()
+                shm = attached[slot] = attach(name)
+            img = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            encoded = {}
+            for variant in variants:
+                factor, quality = variant
+                encoded[variant] = bytes(encode_jpeg(downscale(img, factor), quality, bgr))
+            del img
+            results.put((job, slot, encoded, None, (monotonic() - start, thread_time() - cpu)))
+        except Exception as e:
+            # A view left from a failed encode would keep the block from being closed
+            img = None
+            results.put((job, slot, None, str(e), None))
+    for shm in attached.values():
+        shm.close()
+
+
+# Encodes frames in worker processes, so JPEG encoding runs on all cores instead of competing for one GIL.
+# Frames are copied into shared memory slots, encoded in parallel, and published to the broker in the order
+# they were submitted. submit() blocks while every slot is busy; the drop oldest queue before it keeps
+# the camera from stalling. Several cameras can share one pool, each submitting to its own broker.
+# Their frames are published in order per broker, and the slots are handed out first come first served,
+# so a camera with a high frame rate can't starve the others.
+# A job that gets no result within jobTimeout is published without encodes, for the broker to encode on
+# demand. When a worker dies, e.g. from the OOM killer, every worker is started again on new queues.
+class EncoderPool(object):
+    def __init__(self, broker=None, workers=3, logger=None):
+        self.broker = broker  # Default broker for submit()
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.context = get_context('spawn')  # Forking a process with running camera threads isn't safe
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        self.workers = [self.start_worker() for _ in range(workers)]
+        self.jobTimeout = 5  # Seconds
+        self.closing = False
+        # One slot per worker plus one being filled
+        self.slots = [None] * (workers + 1)
+        self.freeSlots = list(range(len(self.slots)))
+        self.slotCondition = Condition()
+        self.nextTicket = 0
+        self.servingTicket = 0
+        self.condition = Condition()
+        self.nextJob = 0
+        self.pending = {}  # Job -> [broker, frame, encoded], encoded is None until the job is done
+        self.dispatched = {}  # Job -> (slot, time it was sent) of the jobs the workers are encoding
+        self.order = {}  # Broker -> deque of its unpublished jobs, in submission order
+        self.collector = Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def start_worker(self):
+        worker = self.context.Process(target=encode_worker, args=(self.tasks, self.results), daemon=True)
+        worker.start()
+        return worker
+
+    # Waits for a free slot. Waiting submitters are served in the order they arrived, so a camera that submits
+    # again right away can't take a slot that frees up before a camera that was already waiting for one.
+    def acquire_slot(self):
+        with self.slotCondition:
+            ticket = self.nextTicket
+            self.nextTicket += 1
+            while ticket != self.servingTicket or not self.freeSlots:
+                self.slotCondition.wait()
+            self.servingTicket += 1
+            slot = self.freeSlots.pop()
+            self.slotCondition.notify_all()
+            return slot
+
+    def release_slot(self, slot):
+        with self.slotCondition:
+            self.freeSlots.append(slot)
+            self.slotCondition.notify_all()
+
+    def submit(self, frame, broker=None):
+        broker = broker if broker is not None else self.broker
+        variants = broker.active_variants()
+        frame.retain()
+        with self.condition:
+            job = self.nextJob
+            self.nextJob += 1
+            self.pending[job] = [broker, frame, None]
+            self.order.setdefault(broker, deque()).append(job)
+        if not variants:
+            # Nobody is watching, nothing to encode. It still has to wait for its turn to be published.
+            self.complete(job, None)
+            return
+        slot = self.acquire_slot()
+        shm = self.slots[slot]
+        if shm is None or shm.size < frame.img.nbytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = SharedMemory(create=True, size=frame.img.nbytes)
+            self.slots[slot] = shm
+        np.ndarray(frame.img.shape, dtype=frame.img.dtype, buffer=shm.buf)[...] = frame.img
+        with self.condition:
+            self.dispatched[job] = (slot, monotonic())
+        self.tasks.put((job, slot, shm.name, frame.img.shape, frame.img.dtype.str, frame.bgr, variants))
+
+    def collect(self):
+        lastCheck = monotonic()
+        while True:
+            if monotonic() > lastCheck + 1:
+                self.check_workers()
+                lastCheck = monotonic()
+            try:
+                job, slot, encoded, error, times = self.results.get(timeout=1)
+            except Empty:
+                continue
+            with self.condition:
+                if self.dispatched.pop(job, None) is None:
+                    # It timed out and was published already, and its slot is in use again
+                    continue
+                broker = self.pending[job][0]
+            self.release_slot(slot)
+            if encoded:
+                # Wall and CPU time in the worker
+                broker.metrics.observe('encode', *times)
+            if error is not None:
+                # The broker encodes the frame on demand instead
+                self.logger.error('Encoding frame failed: {}'.format(error))
+            self.complete(job, encoded)
+
+    # Restarts the workers if one of them died or hangs, and fails the jobs they were encoding.
+    # Otherwise the brokers of the lost jobs would never publish again.
+    def check_workers(self):
+        if self.closing:
+            return
+        now = monotonic()
+        for worker in self.workers:
+            if not worker.is_alive():
+                self.logger.error('Encoder worker {} exited with code {}.'.format(worker.pid, worker.exitcode))
+        with self.condition:
+            hung = any(now > start + self.jobTimeout for _, start in self.dispatched.values())
+        if not hung and all(worker.is_alive() for worker in self.workers):
+            return
+        self.restart_workers()
+        with self.condition:
+            lost = list(self.dispatched.items())
+            self.dispatched.clear()
+        if lost:
+            self.logger.error('Lost {} encoding jobs, their frames are encoded on demand.'.format(len(lost)))
+        for job, (slot, _) in lost:
+            self.release_slot(slot)
+            self.complete(job, None)
+
+    # A worker killed while it waits for a task or sends a result can leave the lock of a queue taken,
+    # which blocks every other worker. So all of them start again, on new queues.
+    def restart_workers(self):
+        self.logger.warning('Restarting the encoder workers.')
+        for worker in self.workers:
+            worker.kill()
+            worker.join(1)
+        for queue in (self.tasks, self.results):
+            queue.close()
+            queue.cancel_join_thread()
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        self.workers = [self.start_worker() for _ in self.workers]
+
+    # Publishes the finished jobs of the broker in submission order
+    def complete(self, job, encoded):
+        with self.condition:
+            entry = self.pending[job]
+            entry[2] = encoded if encoded is not None else {}
+            order = self.order[entry[0]]
+            ready = []
+            while order and self.pending[order[0]][2] is not None:
+                ready.append(self.pending.pop(order.popleft()))
+            # Publish while holding the lock, so that two threads can't publish out of order
+            for broker, frame, encoded in ready:
+                broker.publish_frame(frame, encoded)
+                frame.release()
+
+    def close(self):
+        self.closing = True
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(5)
+        for shm in self.slots:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
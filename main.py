@@ -1,5 +1,5 @@
 from http import server
-from streaming import StreamingOutput, StreamingServer, StreamingHandler
+from streaming import FrameBroker, StreamingServer, StreamingHandler
 from utils import NetworkChecker
 import logging
 import logging.handlers
@@ -19,20 +19,64 @@ logger.addHandler(consoleHandler)
 logger.addHandler(fileHandler)
 
 if __name__ == '__main__':
-    stream_output = StreamingOutput()
-    latest_output = StreamingOutput()
+    # The ZWO cameras to run, by index or by name. With more than one, each is served at /cam/<id>/stream.mjpg,
+    # /cam/<id>/latest.jpg and so on, and the first one also at the routes without /cam/<id>.
+    camera_ids = [0]
+    brokers = {str(camera_id): FrameBroker() for camera_id in camera_ids}
+    broker = brokers[str(camera_ids[0])]
     network_checker = NetworkChecker(logger)
-    # Uncomment to use the proper camera
-    # from RPiCamera import RPiCamera
-    # thread = RPiCamera(stream_output, latest_output, logger, 0)
     from ZWOCamera import ZWOCamera
-    thread = ZWOCamera(stream_output, latest_output, logger, 0)
+    encoder_pool = None
+    # Uncomment to encode JPEG in worker processes on all cores, shared by all cameras
+    # from encoder_pool import EncoderPool
+    # encoder_pool = EncoderPool(broker, 3, logger)
+    threads = []
     try:
+        sdk = None
+        # Uncomment to run without a camera, on simulated frames
+        # from simulator import SimulatedSDK
+        # sdk = SimulatedSDK(1920, 1080, cameras=len(camera_ids))
+        image_type = None
+        # Makes the RawProcessor of each camera, which keeps buffers of its own
+        raw_processor = lambda: None
+        # Uncomment to capture 16-bit raw frames (image type 2, ASI_IMG_RAW16), binned 2x2 and debayered in software,
+        # and converted to 8 bits
+        # from raw import RawProcessor
+        # image_type = 2
+        # raw_processor = lambda: RawProcessor(bins=2)
+        # Started one by one, so that when a camera can't be opened the finally below stops the others
+        # and the process exits, to be restarted by the service
+        for camera_id in camera_ids:
+            threads.append(ZWOCamera(brokers[str(camera_id)], logger, 0, encoder_pool, sdk=sdk, imageType=image_type,
+                                     cameraId=camera_id, rawProcessor=raw_processor()))
+        # Uncomment instead of the loop above to use the proper camera
+        # from RPiCamera import RPiCamera
+        # threads = [RPiCamera(broker, logger, 0)]
+        thread = threads[0]
+        # Uncomment to stack frames, which reduces the noise at night
+        # from stacking import Stacker
+        # thread.stacker = Stacker('mean', 8)
         address = ('', 8000)
-        server = StreamingServer(address, StreamingHandler, stream_output, latest_output)
-        thread.server = server
+        server = StreamingServer(address, StreamingHandler, brokers)
+        # Uncomment to serve many concurrent clients from a single thread
+        # from streaming import AsyncStreamingServer
+        # server = AsyncStreamingServer(address, brokers)
+        # Uncomment to record the stream to disk and play it back from /recordings, served by StreamingServer only
+        # from recorder import Recorder
+        # server.recorder = Recorder(broker, logger, 'recordings')
+        # Uncomment to detect motion, with the events served at /motion
+        # from motion import MotionDetector
+        # thread.motionDetector = server.motion = MotionDetector()
+        # Uncomment as well to record the frames around motion, with the recorder not in continuous mode
+        # thread.motionDetector.listeners.append(lambda event: server.recorder.trigger())
+        # Uncomment to build the keogram and time-lapse of the night, at /keogram.jpg and /timelapse.mjpg
+        # from allsky import AllSkyProducts
+        # server.products = AllSkyProducts(broker)
         logger.info('Starting serving...')
         server.serve_forever()
     finally:
-        thread.terminate = True
+        for thread in threads:
+            thread.terminate = True
         network_checker.terminate = True
+        if encoder_pool is not None:
+            encoder_pool.close()
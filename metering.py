@@ -0,0 +1,88 @@
+import numpy as np
+
+
+# Brightness histogram of a frame. Shared by auto exposure and the later stages that need frame statistics.
+class Histogram(object):
+    def __init__(self, counts):
+        self.counts = counts
+        self.total = counts.sum()
+        self.cumsum = None
+
+    def percentile(self, p):
+        if self.total == 0:
+            return 0
+        if self.cumsum is None:
+            self.cumsum = np.cumsum(self.counts)
+        return int(np.searchsorted(self.cumsum, self.total * p / 100.0))
+
+    @property
+    def median(self):
+        return self.percentile(50)
+
+    @property
+    def mean(self):
+        if self.total == 0:
+            return 0
+        return float(np.dot(self.counts, np.arange(len(self.counts)))) / self.total
+
+
+# A circular mask for all-sky cameras, True inside the circle. Use it as the roi to ignore the horizon.
+def circle_mask(shape, radius=0.5, center=None):
+    height, width = shape[:2]
+    cy, cx = center if center is not None else ((height - 1) / 2, (width - 1) / 2)
+    y, x = np.ogrid[:height, :width]
+    return (y - cy) ** 2 + (x - cx) ** 2 <= (radius * min(height, width)) ** 2
+
+
+# Measures frame brightness from a strided subsample, through a histogram instead of a full frame median.
+# Modes:
+#   'full': every sampled pixel counts the same
+#   'center': pixels are weighted by their distance to the center
+#   'roi': only pixels where mask is True count, e.g. circle_mask() to ignore the horizon of an all-sky camera
+class Meter(object):
+    def __init__(self, stride=4, mode='full', mask=None, centerSigma=0.25):
+        self.stride = stride
+        self.mode = mode
+        self.mask = mask  # Boolean mask for the 'roi' mode, scaled to the frame if it has another size
+        self.centerSigma = centerSigma  # Falloff of the 'center' weights, relative to the frame size
+        self.weightsCache = {}
+
+    def sample(self, img):
+        # A strided view, which doesn't copy the frame
+        return img[::self.stride, ::self.stride]
+
+    # Weights of the pixels of a sample of the given shape, from a frame of frameShape
+    def weights(self, shape, frameShape):
+        key = (self.mode, shape, frameShape)
+        weights = self.weightsCache.get(key)
+        if weights is not None:
+            return weights
+        if self.mode == 'center':
+            y = np.linspace(-0.5, 0.5, shape[0])[:, None]
+            x = np.linspace(-0.5, 0.5, shape[1])[None, :]
+            weights = np.exp(-(x ** 2 + y ** 2) / (2 * self.centerSigma ** 2))
+        elif self.mode == 'roi':
+            # Nearest neighbor, e.g. for a mask of the sensor size on a binned frame
+            rows = np.arange(shape[0]) * self.stride * self.mask.shape[0] // frameShape[0]
+            columns = np.arange(shape[1]) * self.stride * self.mask.shape[1] // frameShape[1]
+            weights = self.mask[rows[:, None], columns[None, :]]
+        else:
+            raise ValueError('Unknown metering mode {}'.format(self.mode))
+        if len(shape) == 3:
+            # Color frames: every channel gets the weight of its pixel
+            weights = np.repeat(weights[:, :, None], shape[2], axis=2)
+        weights = np.ascontiguousarray(weights).ravel()
+        self.weightsCache = {key: weights}
+        return weights
+
+    def measure(self, img):
+        sample = self.sample(img)
+        bins = np.iinfo(img.dtype).max + 1
+        values = sample.ravel()
+        if self.mode == 'full':
+            counts = np.bincount(values, minlength=bins)
+        elif self.mode == 'roi':
+            counts = np.bincount(values[self.weights(sample.shape, img.shape[:2])], minlength=bins)
+        else:
+            counts = np.bincount(values, weights=self.weights(sample.shape, img.shape[:2]), minlength=bins)
+        return Histogram(counts)
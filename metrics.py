@@ -0,0 +1,135 @@
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+from time import monotonic, thread_time
+
+
+# Upper bounds of the timing buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+# A fixed size histogram of durations. Observing only increments a bucket, nothing grows per frame.
+class Timing(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.cpuSum = 0.0  # CPU time of the thread that ran the stage, of the observations that have it
+        self.cpuCount = 0
+
+    def observe(self, seconds, cpu=None):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        if cpu is not None:
+            self.cpuSum += cpu
+            self.cpuCount += 1
+
+
+# Wall time and CPU time of the calling thread, the start of a stage for Metrics.observe_since()
+def clock():
+    return monotonic(), thread_time()
+
+
+# The rate of events over the last few of them, e.g. the capture frame rate
+class RateMeter(object):
+    def __init__(self, window=32):
+        self.times = deque(maxlen=window)
+
+    def tick(self):
+        self.times.append(monotonic())
+
+    def rate(self):
+        if len(self.times) < 2 or monotonic() - self.times[-1] > 10:
+            return 0.0
+        return (len(self.times) - 1) / max(1e-9, self.times[-1] - self.times[0])
+
+
+# Pipeline metrics: per stage timings, counters, and values read when the metrics are rendered.
+# The hot path only takes a lock and increments a few numbers. Time stages with clock(), which also
+# measures the CPU time of the stage, as each stage runs in a thread of its own:
+#     start = clock()
+#     ...
+#     metrics.observe_since('encode', start)
+class Metrics(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.timings = {}  # Stage -> Timing
+        self.counters = {}  # Name -> value
+        self.callbacks = {}  # Name -> (type, help, function returning the value)
+        self.help = {}
+
+    # seconds of wall time, and optionally cpu seconds of the thread
+    def observe(self, stage, seconds, cpu=None):
+        with self.lock:
+            timing = self.timings.get(stage)
+            if timing is None:
+                timing = self.timings[stage] = Timing()
+            timing.observe(seconds, cpu)
+
+    # start is from clock(), in the same thread
+    def observe_since(self, stage, start):
+        wall, cpu = start
+        self.observe(stage, monotonic() - wall, thread_time() - cpu)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def describe(self, name, help):
+        with self.lock:
+            self.help[name] = help
+
+    # Registers a value that is read when rendering, type is 'gauge' or 'counter'
+    def register(self, name, type, help, function):
+        with self.lock:
+            self.callbacks[name] = (type, help, function)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in sorted(labels.items())) + '}'
+
+
+# Renders metrics in the Prometheus text format. sources is a list of (labels, Metrics), so the metrics
+# of several pipelines can be told apart by their labels, e.g. [({'camera': '0'}, metrics)].
+def render(sources, prefix='zwoipcam_'):
+    families = {}  # Name -> (type, help, lines)
+    def family(name, type, help):
+        return families.setdefault(prefix + name, (type, help, []))[2]
+    for labels, metrics in sources:
+        with metrics.lock:
+            timings = [(stage, list(t.counts), t.sum, t.count, t.cpuSum, t.cpuCount) for stage, t in metrics.timings.items()]
+            counters = dict(metrics.counters)
+            helps = dict(metrics.help)
+            callbacks = dict(metrics.callbacks)
+        lines = family('stage_seconds', 'histogram', 'Time spent per frame in each pipeline stage.')
+        cpuLines = family('stage_cpu_seconds_total', 'counter', 'CPU time of the thread running each pipeline stage.')
+        for stage, counts, total, count, cpuTotal, cpuCount in sorted(timings):
+            stageLabels = dict(labels, stage=stage)
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += n
+                lines.append('%sstage_seconds_bucket%s %d' % (prefix, format_labels(dict(stageLabels, le=bound)), cumulative))
+            lines.append('%sstage_seconds_sum%s %.6f' % (prefix, format_labels(stageLabels), total))
+            lines.append('%sstage_seconds_count%s %d' % (prefix, format_labels(stageLabels), count))
+            if cpuCount:
+                cpuLines.append('%sstage_cpu_seconds_total%s %.6f' % (prefix, format_labels(stageLabels), cpuTotal))
+        for name, value in sorted(counters.items()):
+            family(name, 'counter', helps.get(name, name)).append('%s%s%s %s' % (prefix, name, format_labels(labels), value))
+        for name, (type, help, function) in sorted(callbacks.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            family(name, type, help).append('%s%s%s %s' % (prefix, name, format_labels(labels), value))
+    output = []
+    for name, (type, help, lines) in sorted(families.items()):
+        if not lines:
+            continue
+        output.append('# HELP %s %s' % (name, help))
+        output.append('# TYPE %s %s' % (name, type))
+        output.extend(lines)
+    return '\n'.join(output) + '\n'
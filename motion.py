@@ -0,0 +1,147 @@
+from collections import deque
+from threading import Lock
+import numpy as np
+
+
+# Labels the 4-connected regions of a boolean mask. Each region gets the flat index of its first cell.
+# Labels spread to the neighbours and then jump to the label of their label, so it converges in a few
+# vectorized passes even for large regions. Cells outside the mask are labelled mask.size.
+def label_regions(mask):
+    outside = mask.size
+    labels = np.where(mask, np.arange(mask.size).reshape(mask.shape), outside)
+    inside = mask.ravel()
+    while True:
+        spread = labels.copy()
+        np.minimum(spread[1:], labels[:-1], out=spread[1:])
+        np.minimum(spread[:-1], labels[1:], out=spread[:-1])
+        np.minimum(spread[:, 1:], labels[:, :-1], out=spread[:, 1:])
+        np.minimum(spread[:, :-1], labels[:, 1:], out=spread[:, :-1])
+        spread[~mask] = outside
+        flat = spread.ravel()
+        flat[inside] = flat[flat[inside]]
+        if np.array_equal(spread, labels):
+            return labels
+        labels = spread
+
+
+# Detects motion on the raw frames, before they are stretched or annotated, so nothing has to be decoded again.
+# Frames are block averaged into a small gray copy and compared to a background that is an exponential moving
+# average of the previous copies. Blocks that differ by more than threshold are grouped into regions, and
+# regions of at least minBlocks blocks are reported as an event with their boxes and scores.
+# All the per frame buffers are preallocated at the size of the small copy.
+class MotionDetector(object):
+    def __init__(self, block=8, alpha=0.05, threshold=20, minBlocks=4, maxChanged=0.5, history=50):
+        self.block = block  # Side of the averaged blocks in pixels
+        self.alpha = alpha  # Weight of a new frame in the background
+        self.threshold = threshold  # In 8-bit units
+        self.minBlocks = minBlocks  # Smaller regions are noise
+        self.maxChanged = maxChanged  # Changes over a larger fraction of the frame are lighting, not motion
+        self.shape = None
+        self.rows = None
+        self.small = None
+        self.background = None
+        self.diff = None
+        self.absdiff = None
+        self.mask = None
+        self.settings = None
+        self.nextId = 1
+        self.events = deque(maxlen=history)
+        self.lock = Lock()
+        # Callbacks invoked with every event from the process stage. They must not block.
+        self.listeners = []
+
+    def allocate(self, shape):
+        self.shape = shape
+        size = (shape[0] // self.block, shape[1] // self.block)
+        self.rows = np.empty((size[0], size[1] * self.block) + shape[2:], np.uint32)
+        self.small = np.empty(size, np.float32)
+        self.background = np.empty(size, np.float32)
+        self.diff = np.empty(size, np.float32)
+        self.absdiff = np.empty(size, np.float32)
+        self.mask = np.empty(size, bool)
+
+    # The background is learned again from the next frame, e.g. after the exposure changed
+    def reset(self):
+        self.settings = None
+
+    # Block averages img into self.small, in 8-bit units
+    def shrink(self, img):
+        b = self.block
+        height, width = self.small.shape
+        # Sum the rows of each block first and then the columns, which is several times faster than summing
+        # both axes of the blocks at once. The partial blocks at the edges are cropped.
+        img[:height * b, :width * b].reshape((height, b, width * b) + img.shape[2:]).sum(axis=1, out=self.rows)
+        axes = (2, 3) if img.ndim == 3 else 2
+        self.rows.reshape((height, width, b) + img.shape[2:]).sum(axis=axes, dtype=np.float32, out=self.small)
+        channels = img.shape[2] if img.ndim == 3 else 1
+        self.small *= 255.0 / np.iinfo(img.dtype).max / (b * b * channels)
+
+    # Returns the event for the frame, or None if nothing moved
+    def detect(self, frame):
+        img = frame.img
+        if img.shape != self.shape:
+            self.allocate(img.shape)
+            self.settings = None
+        self.shrink(img)
+        settings = (frame.gain, frame.exposure)
+        if settings != self.settings:
+            # The brightness of the whole frame changes with the exposure
+            self.settings = settings
+            self.background[...] = self.small
+            return None
+        np.subtract(self.small, self.background, out=self.diff)
+        np.abs(self.diff, out=self.absdiff)
+        np.greater(self.absdiff, self.threshold, out=self.mask)
+        # Update the background in place
+        self.diff *= self.alpha
+        self.background += self.diff
+        changed = np.count_nonzero(self.mask)
+        if changed < self.minBlocks:
+            return None
+        if changed > self.maxChanged * self.mask.size:
+            self.background[...] = self.small
+            return None
+        regions = self.regions()
+        if not regions:
+            return None
+        with self.lock:
+            event = {
+                'id': self.nextId,
+                'timestamp': frame.timestamp,
+                'score': max(region['score'] for region in regions),
+                'regions': regions,
+            }
+            self.nextId += 1
+            self.events.append(event)
+        for listener in self.listeners:
+            listener(event)
+        return event
+
+    # The regions of the changed blocks, with their boxes in full resolution pixels as [x, y, width, height]
+    def regions(self):
+        labels = label_regions(self.mask)
+        rows, cols = np.nonzero(self.mask)
+        ids, inverse, counts = np.unique(labels[rows, cols], return_inverse=True, return_counts=True)
+        scores = np.bincount(inverse, weights=self.absdiff[rows, cols]) / counts
+        top = np.full(len(ids), self.mask.shape[0])
+        left = np.full(len(ids), self.mask.shape[1])
+        bottom = np.zeros(len(ids), int)
+        right = np.zeros(len(ids), int)
+        np.minimum.at(top, inverse, rows)
+        np.minimum.at(left, inverse, cols)
+        np.maximum.at(bottom, inverse, rows)
+        np.maximum.at(right, inverse, cols)
+        b = self.block
+        regions = []
+        for n in np.flatnonzero(counts >= self.minBlocks):
+            regions.append({
+                'box': [int(left[n]) * b, int(top[n]) * b, int(right[n] - left[n] + 1) * b, int(bottom[n] - top[n] + 1) * b],
+                'blocks': int(counts[n]),
+                'score': round(float(scores[n]), 1),
+            })
+        return sorted(regions, key=lambda region: -region['score'])
+
+    # The recent events with an id larger than after
+    def recent(self, after=0):
+        with self.lock:
+            return [event for event in self.events if event['id'] > after]
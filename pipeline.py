@@ -0,0 +1,113 @@
+from collections import deque
+from threading import Condition, Lock
+from time import time
+
+
+# A bounded queue connecting two pipeline stages.
+# When the consumer falls behind, the oldest item is dropped instead of blocking the producer,
+# so the latency between capture and output stays bounded.
+class DropOldestQueue(object):
+    def __init__(self, maxsize, on_drop=None):
+        self.maxsize = maxsize
+        self.on_drop = on_drop  # Called with the dropped item, e.g. to return its buffer to the pool
+        self.items = deque()
+        self.condition = Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        dropped = None
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                dropped = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    # Returns None on timeout
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.items:
+                self.condition.wait(timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+    def clear(self):
+        with self.condition:
+            items = list(self.items)
+            self.items.clear()
+        if self.on_drop is not None:
+            for item in items:
+                self.on_drop(item)
+
+    def __len__(self):
+        return len(self.items)
+
+
+# A pool of preallocated frame buffers.
+# The camera writes each frame into one of them, so no new array is allocated per frame.
+class FramePool(object):
+    def __init__(self, size, count):
+        self.size = size
+        self.count = count
+        self.free = deque(bytearray(size) for _ in range(count))
+        self.condition = Condition()
+
+    # Returns None if no buffer became available within the timeout
+    def acquire(self, timeout=None):
+        with self.condition:
+            if not self.free:
+                self.condition.wait(timeout)
+            if not self.free:
+                return None
+            return self.free.popleft()
+
+    def release(self, buffer):
+        with self.condition:
+            self.free.append(buffer)
+            self.condition.notify()
+
+
+# A captured frame travelling through the pipeline, together with the settings it was captured with.
+# It is reference counted, since the latest frame is also kept by the broker for on demand encoding.
+class Frame(object):
+    def __init__(self, pool, buffer, img, gain, exposure):
+        self.pool = pool  # None if the frame doesn't come from a pool
+        self.buffer = buffer
+        self.img = img
+        self.gain = gain
+        self.exposure = exposure
+        self.timestamp = time()
+        self.bgr = True  # Color frames from ZWO cameras are in BGR order
+        self.seq = None  # Assigned when published
+        self.histogram = None  # Filled by the process stage
+        self.refs = 1
+        self.lock = Lock()
+
+    def retain(self):
+        with self.lock:
+            self.refs += 1
+        return self
+
+    # Moves the frame to another buffer, e.g. after a stage changed its size, and returns the old one to its pool.
+    # Only for the stage that holds the single reference to the frame.
+    def replace(self, pool, buffer, img):
+        oldPool, oldBuffer = self.pool, self.buffer
+        self.pool = pool
+        self.buffer = buffer
+        self.img = img
+        if oldBuffer is not None and oldPool is not None:
+            oldPool.release(oldBuffer)
+
+    # Returns the underlying buffer to its pool once the last reference is released
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            buffer, self.buffer = self.buffer, None
+            self.img = None
+        if buffer is not None and self.pool is not None:
+            self.pool.release(buffer)
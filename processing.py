@@ -0,0 +1,86 @@
+from io import BytesIO
+from string import printable
+from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+
+
+# Draws a line of text into numpy frames in place, without going through PIL for every frame.
+# Each character is rendered once into a fixed size cell. The text bitmap is kept between frames,
+# and only the cells whose character changed are re-rendered into it, e.g. the seconds of a timestamp.
+class TextOverlay(object):
+    def __init__(self, position=(15, 15), font=None):
+        self.position = position
+        self.font = font if font is not None else ImageFont.load_default()
+        boxes = [self.font.getbbox(ch) for ch in printable if ch.isprintable()]
+        self.cellWidth = max(box[2] for box in boxes)
+        self.cellHeight = max(box[3] for box in boxes)
+        self.glyphs = {}
+        self.text = ''
+        self.bitmap = np.zeros((self.cellHeight, 0), np.uint8)
+
+    def glyph(self, ch):
+        glyph = self.glyphs.get(ch)
+        if glyph is None:
+            cell = Image.new('L', (self.cellWidth, self.cellHeight))
+            ImageDraw.Draw(cell).text((0, 0), ch, fill=255, font=self.font)
+            glyph = np.asarray(cell)
+            self.glyphs[ch] = glyph
+        return glyph
+
+    def update(self, text):
+        if len(text) != len(self.text):
+            self.bitmap = np.zeros((self.cellHeight, self.cellWidth * len(text)), np.uint8)
+            self.text = ' ' * len(text)
+        for i, (old, new) in enumerate(zip(self.text, text)):
+            if old != new:
+                self.bitmap[:, i * self.cellWidth:(i + 1) * self.cellWidth] = self.glyph(new)
+        self.text = text
+
+    # Draws the text in white onto img, which can be gray or color, 8 or 16 bits
+    def draw(self, img, text):
+        self.update(text)
+        x, y = self.position
+        height = max(0, min(self.bitmap.shape[0], img.shape[0] - y))
+        width = max(0, min(self.bitmap.shape[1], img.shape[1] - x))
+        region = img[y:y + height, x:x + width]
+        bitmap = self.bitmap[:height, :width]
+        if img.dtype != np.uint8:
+            bitmap = bitmap.astype(img.dtype) * (np.iinfo(img.dtype).max // 255)
+        if img.ndim == 3:
+            bitmap = bitmap[:, :, None]
+        np.maximum(region, bitmap, out=region)
+
+
+# The single hand-off from a processed numpy frame to the encoder.
+# Gray frames are wrapped without copying. Color frames from ZWO cameras are in BGR order,
+# which PIL converts while unpacking, so there is no separate reversed copy.
+def to_image(img, bgr=True):
+    height, width = img.shape[:2]
+    if img.ndim == 3:
+        return Image.frombuffer('RGB', (width, height), img, 'raw', 'BGR' if bgr else 'RGB', 0, 1)
+    if img.dtype == np.uint16:
+        return Image.frombuffer('I;16', (width, height), img, 'raw', 'I;16', 0, 1)
+    return Image.frombuffer('L', (width, height), img, 'raw', 'L', 0, 1)
+
+
+# Shrinks img by an integer factor with a box filter, by summing the factor x factor blocks of a reshaped view
+def downscale(img, factor):
+    if factor == 1:
+        return img
+    height = img.shape[0] // factor * factor
+    width = img.shape[1] // factor * factor
+    blocks = img[:height, :width].reshape((height // factor, factor, width // factor, factor) + img.shape[2:])
+    sums = blocks.sum(axis=(1, 3), dtype=np.uint32)
+    sums += factor * factor // 2
+    sums //= factor * factor
+    return sums.astype(img.dtype)
+
+
+def encode_jpeg(img, quality=90, bgr=True):
+    # JPEG only holds 8 bits, keep the high byte of 16-bit frames
+    if img.dtype == np.uint16:
+        img = (img >> 8).astype(np.uint8)
+    buff = BytesIO()
+    to_image(img, bgr).save(buff, format='jpeg', quality=quality)
+    # Share the encoded bytes instead of copying them out of the buffer
+    return buff.getbuffer().toreadonly()
@@ -0,0 +1,163 @@
+import numpy as np
+from pipeline import FramePool
+from tonemap import ToneMapper
+
+# Bayer patterns as reported by the ZWO SDK in the camera property BayerPattern
+BAYER_PATTERNS = {0: 'RGGB', 1: 'BGGR', 2: 'GRBG', 3: 'GBRG'}
+# Channel of each color in the BGR frames of the pipeline
+CHANNELS = {'B': 0, 'G': 1, 'R': 2}
+
+
+# Develops raw frames from the sensor with numpy, before the other stages run:
+#   bins: software binning, averaging bins x bins blocks of a reshaped frame. On a Bayer mosaic the pixels
+#         of the same color are binned, so the result is a smaller mosaic with the same pattern.
+#   debayer: bilinear demosaicing of the mosaic into a BGR frame, if the camera has a Bayer pattern.
+#   eightBit: converts 16-bit frames to 8 bits through a LUT, which can include the auto stretch curve.
+# Binning first means the demosaicing and every later stage (metering, stretch, encode) touch fewer pixels.
+# The developed frame moves to a buffer of its own pool, and the raw buffer goes back to the camera.
+class RawProcessor(object):
+    def __init__(self, bins=1, debayer=True, eightBit=True):
+        self.bins = bins
+        self.debayer = debayer
+        self.eightBit = eightBit
+        self.pools = {}  # Buffer size -> FramePool
+        self.scratch = {}  # (name, shape, dtype) -> array reused between frames
+        self.linear = None  # Linear 16 to 8-bit LUT
+
+    def buffer(self, name, shape, dtype):
+        key = (name, shape, np.dtype(dtype).str)
+        arr = self.scratch.get(key)
+        if arr is None:
+            arr = self.scratch[key] = np.empty(shape, dtype)
+        return arr
+
+    # Moves the frame to a buffer for an image of the given shape. Returns None if no buffer is free.
+    def output(self, frame, shape, dtype):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        pool = self.pools.get(size)
+        if pool is None:
+            # As many buffers as the camera has, they travel through the same stages
+            pool = self.pools[size] = FramePool(size, frame.pool.count if frame.pool is not None else 8)
+        buffer = pool.acquire(timeout=1)
+        if buffer is None:
+            return None
+        img = np.frombuffer(buffer, dtype).reshape(shape)
+        return pool, buffer, img
+
+    # Bins and debayers the frame. pattern is the Bayer pattern, e.g. 'RGGB', or None for a mono sensor.
+    # Returns False if the frame should be dropped.
+    def develop(self, frame, pattern=None):
+        img = frame.img
+        if img.ndim != 2 or (self.bins == 1 and (pattern is None or not self.debayer)):
+            return True
+        mosaic = img
+        if self.bins > 1:
+            mosaic = self.bin(img, self.bins, pattern is not None)
+        if pattern is not None and self.debayer:
+            # A Bayer pattern only repeats on even sizes
+            height, width = mosaic.shape[0] // 2 * 2, mosaic.shape[1] // 2 * 2
+            shape, source = (height, width, 3), mosaic[:height, :width]
+        else:
+            shape, source = mosaic.shape, mosaic
+        output = self.output(frame, shape, img.dtype)
+        if output is None:
+            return False
+        pool, buffer, out = output
+        if len(shape) == 3:
+            self.demosaic(source, pattern, out)
+            frame.bgr = True
+        else:
+            out[...] = source
+        frame.replace(pool, buffer, out)
+        return True
+
+    # Averages bins x bins blocks, rounded, into a scratch array of the frame dtype.
+    # The rows of each block are added first, as whole rows, and then the columns of the row sums.
+    def bin(self, img, bins, bayer):
+        # On a Bayer mosaic every other row and column has the same color
+        period = 2 if bayer else 1
+        block = bins * period
+        height, width = img.shape[0] // block * block, img.shape[1] // block * block
+        # Sums of 16 pixels of 8 bits fit in 16 bits
+        wide = np.uint16 if img.dtype == np.uint8 and bins <= 4 else np.uint32
+        rows = img[:height, :width].reshape(height // block, bins, period, width)
+        rowSums = self.buffer('rows', (height // block, period, width), wide)
+        np.copyto(rowSums, rows[:, 0])
+        for i in range(1, bins):
+            rowSums += rows[:, i]
+        columns = rowSums.reshape(height // bins, width // block, bins, period)
+        sums = self.buffer('bin', (height // bins, width // block, period), wide)
+        np.copyto(sums, columns[:, :, 0])
+        for j in range(1, bins):
+            sums += columns[:, :, j]
+        sums += bins * bins // 2
+        sums //= bins * bins
+        binned = self.buffer('binned', (height // bins, width // bins), img.dtype)
+        np.copyto(binned, sums.reshape(binned.shape), casting='unsafe')
+        return binned
+
+    # Bilinear demosaicing into out, a BGR frame of the mosaic size. Each of the four sites of the 2x2 pattern
+    # is handled as a quarter size plane, where every missing color is the average of the 2 or 4 nearest
+    # pixels of that color. The edges are mirrored, which keeps the colors of the pattern.
+    # The mosaic is split into contiguous quarter planes first, so the neighbors are plain offsets into them.
+    def demosaic(self, mosaic, pattern, out):
+        height, width = mosaic.shape
+        # Sums of 4 pixels of 8 bits fit in 16 bits
+        wide = np.uint16 if mosaic.dtype == np.uint8 else np.uint32
+        padded = self.buffer('padded', (height + 2, width + 2), mosaic.dtype)
+        padded[1:-1, 1:-1] = mosaic
+        padded[0, 1:-1] = mosaic[1]
+        padded[-1, 1:-1] = mosaic[-2]
+        padded[:, 0] = padded[:, 2]
+        padded[:, -1] = padded[:, -3]
+        quarters = [[None, None], [None, None]]
+        for y in range(2):
+            for x in range(2):
+                quarters[y][x] = self.buffer('quarter{}{}'.format(y, x), (height // 2 + 1, width // 2 + 1), wide)
+                np.copyto(quarters[y][x], padded[y::2, x::2])
+        plane = self.buffer('plane', (height // 2, width // 2), wide)
+        colors = [pattern[:2], pattern[2:]]
+        for y in range(2):
+            for x in range(2):
+                def near(dy, dx):
+                    row, column = 1 + y + dy, 1 + x + dx
+                    quarter = quarters[row % 2][column % 2]
+                    return quarter[row // 2:row // 2 + height // 2, column // 2:column // 2 + width // 2]
+                own = colors[y][x]
+                horizontal, vertical = colors[y][1 - x], colors[1 - y][x]
+                for color, channel in CHANNELS.items():
+                    target = out[y::2, x::2, channel]
+                    if color == own:
+                        np.copyto(target, near(0, 0), casting='unsafe')
+                        continue
+                    if color == horizontal and color == vertical:
+                        neighbors = ((-1, 0), (1, 0), (0, -1), (0, 1))
+                    elif color == horizontal:
+                        neighbors = ((0, -1), (0, 1))
+                    elif color == vertical:
+                        neighbors = ((-1, 0), (1, 0))
+                    else:
+                        neighbors = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+                    np.add(near(*neighbors[0]), near(*neighbors[1]), out=plane)
+                    for dy, dx in neighbors[2:]:
+                        plane += near(dy, dx)
+                    # Rounded average of 2 or 4 pixels, shifted straight into the frame
+                    shift = len(neighbors) // 2
+                    plane += 1 << (shift - 1)
+                    np.right_shift(plane, shift, out=target, casting='unsafe')
+
+    # Converts a 16-bit frame to 8 bits with lut, e.g. a stretch from ToneMapper.get_lut(), or linearly.
+    # Returns False if the frame should be dropped.
+    def to_eight_bit(self, frame, lut=None):
+        img = frame.img
+        if lut is None:
+            if self.linear is None:
+                self.linear = ToneMapper.build_lut('gamma', 1.0, np.dtype(np.uint16), np.dtype(np.uint8))
+            lut = self.linear
+        output = self.output(frame, img.shape, np.uint8)
+        if output is None:
+            return False
+        pool, buffer, out = output
+        ToneMapper.apply(img, lut, out)
+        frame.replace(pool, buffer, out)
+        return True
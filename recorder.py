@@ -0,0 +1,224 @@
+from collections import deque
+from mmap import mmap, ACCESS_READ
+from os import listdir, makedirs, remove
+from os.path import exists, getsize, join
+from threading import Thread
+from time import sleep, time
+import numpy as np
+from pipeline import DropOldestQueue
+
+# One index record per frame: capture timestamp, offset and length of the JPEG in the segment file
+INDEX_DTYPE = np.dtype([('timestamp', '<f8'), ('offset', '<u8'), ('length', '<u4')])
+
+
+# A segment of the recording: the JPEG frames appended to one file, and an index to seek in it.
+class Segment(object):
+    def __init__(self, directory, start):
+        self.start = start
+        self.path = join(directory, 'segment_{:.3f}.mjpg'.format(start))
+        self.indexPath = self.path[:-len('.mjpg')] + '.idx'
+
+    def index(self):
+        if not exists(self.indexPath):
+            return np.zeros(0, INDEX_DTYPE)
+        # Ignore a partially written last record
+        count = getsize(self.indexPath) // INDEX_DTYPE.itemsize
+        return np.fromfile(self.indexPath, dtype=INDEX_DTYPE, count=count)
+
+    def size(self):
+        size = 0
+        for path in (self.path, self.indexPath):
+            if exists(path):
+                size += getsize(path)
+        return size
+
+    def delete(self):
+        for path in (self.path, self.indexPath):
+            if exists(path):
+                remove(path)
+
+
+# Records the encoded frames of the broker into segment files, written by a background thread with large
+# sequential writes. Retention is bounded by a disk quota, the oldest segments are deleted first.
+# It keeps the last preEventSeconds of frames in memory, so that a trigger also saves what led up to it.
+# In continuous mode every frame is recorded, otherwise only the frames around triggers.
+class Recorder(Thread):
+    def __init__(self, broker, logger, directory='recordings', variant=None, continuous=True):
+        super(Recorder, self).__init__(daemon=True)
+        self.broker = broker
+        self.logger = logger
+        self.directory = directory
+        # The frames are recorded as encoded for this variant, full resolution by default
+        self.variant = variant if variant is not None else broker.variant('full')
+        self.continuous = continuous
+        self.segmentSeconds = 600
+        # Segments also end at this size, or a quarter of the quota, since only closed ones can be deleted
+        self.segmentBytes = 256 * 1024 ** 2
+        self.quotaBytes = 8 * 1024 ** 3
+        self.preEventSeconds = 10
+        self.postEventSeconds = 30
+        self.writeBufferSize = 4 * 1024 * 1024
+        self.flushInterval = 5  # Seconds until recorded frames become visible to playback
+        self.terminate = False
+        self.queue = DropOldestQueue(64)
+        self.ring = deque()
+        self.recordUntil = 0
+        self.flushRing = False
+        self.segment = None
+        self.dataFile = None
+        self.indexFile = None
+        self.offset = 0
+        self.lastWritten = 0
+        makedirs(directory, exist_ok=True)
+        # Keep the variant encoded for every frame
+        broker.subscribe(self.variant)
+        broker.listeners.append(self.on_frame)
+        self.start()
+
+    # Called from the producer thread, right after the frame was published
+    def on_frame(self, frame):
+        encoded = self.broker.cached(self.variant)
+        if encoded is not None:
+            self.queue.put(encoded)
+
+    # Records from preEventSeconds ago until seconds from now
+    def trigger(self, seconds=None):
+        self.recordUntil = max(self.recordUntil, time() + (seconds if seconds is not None else self.postEventSeconds))
+        self.flushRing = True
+
+    def run(self):
+        self.logger.info('Recorder launches.')
+        lastFlush = time()
+        try:
+            while not self.terminate:
+                frame = self.queue.get(timeout=1)
+                try:
+                    if frame is not None:
+                        self.ring.append(frame)
+                        while self.ring and self.ring[0].timestamp < frame.timestamp - self.preEventSeconds:
+                            self.ring.popleft()
+                        if self.flushRing:
+                            self.flushRing = False
+                            for old in self.ring:
+                                self.write(old)
+                        elif self.continuous or frame.timestamp < self.recordUntil:
+                            self.write(frame)
+                    if self.dataFile is not None and time() > lastFlush + self.flushInterval:
+                        self.flush()
+                        # The open segment counts as well, as it grows
+                        self.enforce_quota()
+                        lastFlush = time()
+                except OSError as e:
+                    # e.g. a full disk. Recording goes on in a new segment, after making room within the quota.
+                    self.logger.error('Recording failed: {}'.format(e))
+                    self.close_segment()
+                    try:
+                        self.enforce_quota()
+                    except OSError as e:
+                        self.logger.error(e)
+                    sleep(1)
+        except Exception as e:
+            self.logger.error(e)
+        finally:
+            self.close_segment()
+
+    def write(self, frame):
+        if frame.timestamp <= self.lastWritten:
+            return
+        if (self.segment is None or frame.timestamp >= self.segment.start + self.segmentSeconds or
+                self.offset >= min(self.segmentBytes, self.quotaBytes // 4)):
+            self.close_segment()
+            self.open_segment(frame.timestamp)
+        self.dataFile.write(frame.data)
+        record = np.array([(frame.timestamp, self.offset, len(frame.data))], dtype=INDEX_DTYPE)
+        self.indexFile.write(record.tobytes())
+        self.offset += len(frame.data)
+        self.lastWritten = frame.timestamp
+
+    def flush(self):
+        # The data goes first, so the index never points past the end of the segment
+        self.dataFile.flush()
+        self.indexFile.flush()
+
+    def open_segment(self, start):
+        self.segment = Segment(self.directory, start)
+        self.dataFile = open(self.segment.path, 'ab', buffering=self.writeBufferSize)
+        self.indexFile = open(self.segment.indexPath, 'ab', buffering=64 * 1024)
+        self.offset = self.dataFile.tell()
+        self.enforce_quota()
+
+    # Closing flushes the data first, so the index never points past the end of the segment
+    def close_segment(self):
+        files = [f for f in (self.dataFile, self.indexFile) if f is not None]
+        self.dataFile = None
+        self.indexFile = None
+        self.segment = None
+        for f in files:
+            try:
+                f.close()
+            except OSError as e:
+                self.logger.error(e)
+
+    def segments(self):
+        starts = sorted(float(fn[len('segment_'):-len('.mjpg')]) for fn in listdir(self.directory)
+                        if fn.startswith('segment_') and fn.endswith('.mjpg'))
+        return [Segment(self.directory, start) for start in starts]
+
+    def enforce_quota(self):
+        segments = self.segments()
+        total = sum(segment.size() for segment in segments)
+        for segment in segments:
+            if total <= self.quotaBytes or (self.segment is not None and segment.path == self.segment.path):
+                break
+            total -= segment.size()
+            self.logger.info('Deleting {} to stay within the disk quota.'.format(segment.path))
+            segment.delete()
+
+    # Summary of the recorded segments
+    def list(self):
+        result = []
+        for segment in self.segments():
+            index = segment.index()
+            if len(index) == 0:
+                continue
+            result.append({
+                'start': float(index['timestamp'][0]),
+                'end': float(index['timestamp'][-1]),
+                'frames': len(index),
+                'bytes': segment.size(),
+            })
+        return result
+
+    # Yields (timestamp, JPEG data) of the recorded frames between start and end, read through memory maps
+    def frames(self, start, end):
+        segments = self.segments()
+        for n, segment in enumerate(segments):
+            # Segments that end before start can be skipped without reading their index
+            if n + 1 < len(segments) and segments[n + 1].start <= start:
+                continue
+            if segment.start > end:
+                break
+            index = segment.index()
+            if len(index) == 0:
+                continue
+            first = np.searchsorted(index['timestamp'], start)
+            last = np.searchsorted(index['timestamp'], end, side='right')
+            if first >= last:
+                continue
+            with open(segment.path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+                for timestamp, offset, length in index[first:last]:
+                    yield float(timestamp), mm[offset:offset + length]
+
+    # The last recorded frame at or before timestamp, as (timestamp, JPEG data), or None
+    def frame_at(self, timestamp):
+        for segment in reversed(self.segments()):
+            if segment.start > timestamp:
+                continue
+            index = segment.index()
+            n = np.searchsorted(index['timestamp'], timestamp, side='right') - 1
+            if n < 0:
+                continue
+            _, offset, length = index[n]
+            with open(segment.path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+                return float(index['timestamp'][n]), mm[offset:offset + int(length)]
+        return None
@@ -0,0 +1,273 @@
+from glob import glob
+from io import BytesIO
+from os.path import isdir, join
+from random import Random
+from time import monotonic, sleep
+import numpy as np
+
+# Image types and control ids, with the same values as zwoasi
+ASI_IMG_RAW8 = 0
+ASI_IMG_RGB24 = 1
+ASI_IMG_RAW16 = 2
+ASI_IMG_Y8 = 3
+ASI_GAIN = 0
+ASI_EXPOSURE = 1
+ASI_GAMMA = 2
+ASI_WB_R = 3
+ASI_WB_B = 4
+ASI_OFFSET = 5
+ASI_BANDWIDTHOVERLOAD = 6
+ASI_FLIP = 9
+ASI_AUTO_MAX_GAIN = 10
+ASI_AUTO_MAX_EXP = 11
+ASI_AUTO_MAX_BRIGHTNESS = 12
+
+# Name, min, max, default
+CONTROLS = [
+    ('Gain', ASI_GAIN, 0, 510, 0),
+    ('Exposure', ASI_EXPOSURE, 32, 2000000000, 10000),
+    ('Gamma', ASI_GAMMA, 1, 100, 50),
+    ('WB_R', ASI_WB_R, 1, 99, 52),
+    ('WB_B', ASI_WB_B, 1, 99, 95),
+    ('Offset', ASI_OFFSET, 0, 600, 8),
+    ('BandWidth', ASI_BANDWIDTHOVERLOAD, 40, 100, 50),
+    ('Flip', ASI_FLIP, 0, 3, 0),
+    ('AutoExpMaxGain', ASI_AUTO_MAX_GAIN, 0, 510, 255),
+    ('AutoExpMaxExpMS', ASI_AUTO_MAX_EXP, 1, 60000, 100),
+    ('AutoExpTargetBrightness', ASI_AUTO_MAX_BRIGHTNESS, 50, 160, 100),
+]
+
+DTYPES = {ASI_IMG_RAW8: np.uint8, ASI_IMG_Y8: np.uint8, ASI_IMG_RAW16: np.uint16, ASI_IMG_RGB24: np.uint8}
+
+
+class SimulatedCameraError(Exception):
+    pass
+
+
+# Loads frames to replay, from a directory of images or of recorder segments, as numpy arrays of image_type.
+def load_frames(path, image_type=ASI_IMG_RAW8, limit=100):
+    from PIL import Image
+    if isdir(path) and glob(join(path, 'segment_*.mjpg')):
+        from recorder import Segment
+        images = []
+        for fn in sorted(glob(join(path, 'segment_*.mjpg'))):
+            segment = Segment(path, float(fn.rsplit('segment_', 1)[1][:-len('.mjpg')]))
+            with open(segment.path, 'rb') as f:
+                data = f.read()
+            for _, offset, length in segment.index():
+                images.append(BytesIO(data[offset:offset + length]))
+    else:
+        images = sorted(glob(join(path, '*'))) if isdir(path) else [path]
+    frames = []
+    for image in images[:limit]:
+        image = Image.open(image)
+        if image_type == ASI_IMG_RGB24:
+            # Frames from the camera are in BGR order
+            frames.append(np.ascontiguousarray(np.asarray(image.convert('RGB'))[:, :, ::-1]))
+        elif image_type == ASI_IMG_RAW16:
+            frames.append(np.asarray(image.convert('L')).astype(np.uint16) * 257)
+        else:
+            frames.append(np.asarray(image.convert('L')))
+    if not frames:
+        raise ValueError('No frames to replay in {}'.format(path))
+    return frames
+
+
+# A camera that behaves like zwoasi.Camera in video mode, without the hardware.
+# Frames are synthetic, a sky gradient with stars whose brightness follows the exposure and gain,
+# or replayed from recorded frames, which ignore the exposure.
+class SimulatedCamera(object):
+    def __init__(self, sdk, id_):
+        self.sdk = sdk
+        self.id = id_
+        self.controls = {control: default for _, control, _, _, default in CONTROLS}
+        self.auto = {control: False for _, control, _, _, _ in CONTROLS}
+        self.roi = [sdk.width, sdk.height, 1, sdk.imageType]
+        self.capturing = False
+        self.closed = False
+        self.lastFrame = 0
+        self.count = 0
+        self.failing = 0  # Captures left in the current burst of failures
+        self.patterns = None
+        self.random = Random(sdk.seed + id_)
+
+    def get_camera_property(self):
+        return {
+            'Name': 'ZWO ASI Simulator {}'.format(self.id),
+            'CameraID': self.id,
+            'MaxHeight': self.sdk.height,
+            'MaxWidth': self.sdk.width,
+            'IsColorCam': True,
+            'BayerPattern': 0,
+            'SupportedBins': [1, 2, 3, 4],
+            'SupportedVideoFormat': [ASI_IMG_RAW8, ASI_IMG_RGB24, ASI_IMG_RAW16, ASI_IMG_Y8],
+            'PixelSize': 2.9,
+            'BitDepth': 12,
+        }
+
+    def get_controls(self):
+        return {name: {'Name': name, 'ControlType': control, 'MinValue': low, 'MaxValue': high,
+                       'DefaultValue': default, 'IsAutoSupported': True, 'IsWritable': True}
+                for name, control, low, high, default in CONTROLS}
+
+    def get_control_values(self):
+        return {name: self.controls[control] for name, control, _, _, _ in CONTROLS}
+
+    def get_control_value(self, control_type):
+        return [self.controls[control_type], self.auto[control_type]]
+
+    def set_control_value(self, control_type, value, auto=False):
+        self.controls[control_type] = int(value)
+        self.auto[control_type] = auto
+
+    def auto_wb(self):
+        self.auto[ASI_WB_R] = self.auto[ASI_WB_B] = True
+
+    def get_roi_format(self):
+        return list(self.roi)
+
+    def set_image_type(self, image_type):
+        self.roi[3] = image_type
+        self.patterns = None
+
+    def set_roi(self, start_x=None, start_y=None, width=None, height=None, bins=None, image_type=None):
+        bins = bins or self.roi[2]
+        self.roi = [width or self.sdk.width // bins, height or self.sdk.height // bins, bins,
+                    self.roi[3] if image_type is None else image_type]
+        self.patterns = None
+
+    def start_video_capture(self):
+        self.capturing = True
+
+    def stop_video_capture(self):
+        self.capturing = False
+
+    def stop_exposure(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    # A few noisy frames of the scene in relative brightness levels, cycled through while capturing.
+    # Each capture maps them through a LUT for the current exposure, which is cheap next to the pipeline.
+    def make_patterns(self):
+        width, height, _, image_type = self.roi
+        if self.sdk.replay is not None:
+            return [frame for frame in self.sdk.replay if frame.shape[:2] == (height, width)] or self.sdk.replay
+        levels = 65535 if image_type == ASI_IMG_RAW16 else 255
+        rng = np.random.default_rng(self.sdk.seed + self.id)
+        y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+        x = np.linspace(-1, 1, width, dtype=np.float32)[None, :]
+        # Brighter towards the horizon at the bottom, the mean level is about 1
+        sky = 0.4 + 1.2 * y * y + 0.2 * x * x
+        stars = rng.random((height, width), dtype=np.float32) > 0.999
+        sky[stars] = 4
+        shape = (height, width, 3) if image_type == ASI_IMG_RGB24 else (height, width)
+        patterns = []
+        for _ in range(self.sdk.patternCount):
+            noisy = sky[:, :, None] if image_type == ASI_IMG_RGB24 else sky
+            noisy = noisy * rng.normal(1, self.sdk.noise, shape).astype(np.float32)
+            # Relative brightness 1 is a quarter of the levels
+            pattern = np.clip(noisy * levels / 4, 0, levels)
+            patterns.append(pattern.astype(np.uint16 if image_type == ASI_IMG_RAW16 else np.uint8))
+        return patterns
+
+    def capture_video_frame(self, buffer_=None, filename=None, timeout=None):
+        if not self.capturing or self.closed:
+            raise SimulatedCameraError('Video capture has not been started')
+        width, height, _, image_type = self.roi
+        exposure = self.controls[ASI_EXPOSURE]
+        # The sensor delivers frames at its frame rate, or slower when the exposure is longer
+        frameTime = 1 / self.sdk.fps
+        if self.sdk.exposureDelay:
+            frameTime = max(frameTime, exposure / 1e6)
+        if timeout is not None and frameTime * 1000 > timeout:
+            sleep(timeout / 1000)
+            raise SimulatedCameraError('Could not read frame')
+        due = self.lastFrame + frameTime
+        now = monotonic()
+        if due > now:
+            sleep(due - now)
+        self.lastFrame = max(due, now)
+        if self.failing == 0 and self.random.random() < self.sdk.failureRate:
+            self.failing = self.sdk.failureBurst
+        if self.failing > 0:
+            self.failing -= 1
+            raise SimulatedCameraError('Could not read frame')
+        if self.patterns is None:
+            self.patterns = self.make_patterns()
+        pattern = self.patterns[self.count % len(self.patterns)]
+        self.count += 1
+        dtype = DTYPES[image_type]
+        shape = (height, width, 3) if image_type == ASI_IMG_RGB24 else (height, width)
+        if buffer_ is None:
+            buffer_ = bytearray(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        img = np.frombuffer(buffer_, dtype=dtype).reshape(shape)
+        if self.sdk.replay is not None:
+            img[...] = pattern[:height, :width]
+        else:
+            levels = np.iinfo(dtype).max
+            # DN per us of exposure at gain 0, for relative brightness 1, as in ae_replay.py. In 8-bit units.
+            value = self.sdk.sceneBrightness * exposure * 10 ** (self.controls[ASI_GAIN] / 200) * levels / 255
+            lut = np.clip(np.arange(levels + 1, dtype=np.float32) * (4 * value / levels), 0, levels).astype(dtype)
+            np.take(lut, pattern, out=img)
+        return img
+
+
+# Stands in for the zwoasi module, e.g. ZWOCamera(broker, logger, sdk=SimulatedSDK(width=1920, height=1080)).
+# imageType is the initial image type of the cameras, ZWOCamera sets its own.
+# sceneBrightness is in DN per us of exposure at gain 0, and can be changed while running.
+# With exposureDelay, a capture takes at least the exposure time. A fraction failureRate of the captures
+# start a glitch, in which failureBurst captures in a row fail.
+# replay is a list of frames, e.g. from load_frames(), to capture instead of the synthetic scene.
+class SimulatedSDK(object):
+    # The zwoasi names, so the sdk can be used in place of the module
+    ASI_IMG_RAW8 = ASI_IMG_RAW8
+    ASI_IMG_RGB24 = ASI_IMG_RGB24
+    ASI_IMG_RAW16 = ASI_IMG_RAW16
+    ASI_IMG_Y8 = ASI_IMG_Y8
+    ASI_GAIN = ASI_GAIN
+    ASI_EXPOSURE = ASI_EXPOSURE
+    ASI_GAMMA = ASI_GAMMA
+    ASI_WB_R = ASI_WB_R
+    ASI_WB_B = ASI_WB_B
+    ASI_OFFSET = ASI_OFFSET
+    ASI_BANDWIDTHOVERLOAD = ASI_BANDWIDTHOVERLOAD
+    ASI_FLIP = ASI_FLIP
+    ASI_AUTO_MAX_GAIN = ASI_AUTO_MAX_GAIN
+    ASI_AUTO_MAX_EXP = ASI_AUTO_MAX_EXP
+    ASI_AUTO_MAX_BRIGHTNESS = ASI_AUTO_MAX_BRIGHTNESS
+    ZWO_Error = SimulatedCameraError
+    ZWO_IOError = SimulatedCameraError
+
+    def __init__(self, width=1920, height=1080, imageType=ASI_IMG_RAW8, fps=30, exposureDelay=True,
+                 failureRate=0, sceneBrightness=0.13, noise=0.05, replay=None, cameras=1, seed=0, failureBurst=1):
+        self.width = width
+        self.height = height
+        self.imageType = imageType
+        self.fps = fps
+        self.exposureDelay = exposureDelay
+        self.failureRate = failureRate
+        self.failureBurst = failureBurst
+        self.sceneBrightness = sceneBrightness
+        self.noise = noise
+        self.patternCount = 4
+        self.seed = seed
+        self.cameras = cameras
+        self.replay = replay
+        if replay:
+            self.height, self.width = replay[0].shape[:2]
+
+    def init(self, library_file=None):
+        pass
+
+    def get_num_cameras(self):
+        return self.cameras
+
+    def list_cameras(self):
+        return ['ZWO ASI Simulator {}'.format(id_) for id_ in range(self.cameras)]
+
+    def Camera(self, id_):
+        if id_ >= self.cameras:
+            raise SimulatedCameraError('Invalid id')
+        return SimulatedCamera(self, id_)
@@ -0,0 +1,119 @@
+import numpy as np
+
+
+# Averages consecutive frames to reduce noise when the exposure is already at its maximum.
+# Modes:
+#   'mean': a running mean, which becomes an exponential moving average with the weight of window frames
+#   'sigma': the mean of the last window frames, ignoring pixels more than sigma standard deviations
+#            from their mean, e.g. planes, satellites and hot pixels
+# The stacked frame is written back into the frame buffer. All the buffers are allocated once per frame shape,
+# and the stack restarts whenever the gain or exposure changes, or reset() is called, e.g. on motion.
+class Stacker(object):
+    def __init__(self, mode='mean', window=8, sigma=2.5):
+        self.mode = mode
+        self.window = window
+        self.sigma = sigma
+        self.shape = None
+        self.dtype = None
+        self.settings = None
+        self.count = 0  # Frames in the stack
+        self.next = 0  # Slot of the next frame in the window of the 'sigma' mode
+
+    def allocate(self, shape, dtype):
+        self.shape = shape
+        self.dtype = dtype
+        self.mean = np.zeros(shape, np.float32)
+        self.tmp = np.empty(shape, np.float32)
+        if self.mode == 'sigma':
+            self.frames = np.empty((self.window,) + shape, dtype)
+            # Integer pixels keep the running sums exact, as long as the squares of 16-bit pixels are summed in float64
+            exact = np.float32 if dtype == np.uint8 else np.float64
+            self.sum = np.empty(shape, np.float32)
+            self.sumsq = np.empty(shape, exact)
+            self.spread = np.empty(shape, exact)
+            self.squares = np.empty(shape, exact)
+            self.low = np.empty(shape, dtype)
+            self.high = np.empty(shape, dtype)
+            self.inside = np.empty(shape, bool)
+            self.below = np.empty(shape, bool)
+            self.total = np.empty(shape, np.float32)
+            self.kept = np.empty(shape, np.uint8)
+
+    def reset(self):
+        self.count = 0
+        self.next = 0
+
+    # Adds the frame to the stack, and replaces its image with the stacked one in place
+    def stack(self, frame):
+        img = frame.img
+        if img.shape != self.shape or img.dtype != self.dtype:
+            self.allocate(img.shape, img.dtype)
+            self.reset()
+        settings = (frame.gain, frame.exposure)
+        if settings != self.settings:
+            self.settings = settings
+            self.reset()
+        if self.mode == 'sigma':
+            self.add_clipped(img)
+        else:
+            self.add_mean(img)
+        # Round back into the frame buffer
+        np.rint(self.mean, out=self.tmp)
+        np.copyto(img, self.tmp, casting='unsafe')
+
+    def add_mean(self, img):
+        self.count = min(self.count + 1, self.window)
+        np.subtract(img, self.mean, out=self.tmp)
+        self.tmp *= 1.0 / self.count
+        self.mean += self.tmp
+
+    # The window keeps running sums of the pixels and their squares, so every frame is added and removed once.
+    # Only the clipping goes over all the frames of the window, comparing them in their own dtype.
+    def add_clipped(self, img):
+        if self.count == 0:
+            self.sum[...] = 0
+            self.sumsq[...] = 0
+        if self.count == self.window:
+            # The oldest frame leaves the window
+            old = self.frames[self.next]
+            self.sum -= old
+            np.square(old, out=self.squares, dtype=self.squares.dtype)
+            self.sumsq -= self.squares
+        else:
+            self.count += 1
+        self.frames[self.next] = img
+        self.next = (self.next + 1) % self.window
+        self.sum += img
+        np.square(img, out=self.squares, dtype=self.squares.dtype)
+        self.sumsq += self.squares
+        n = self.count
+        np.multiply(self.sum, 1.0 / n, out=self.mean)
+        if n < 3:
+            # Too few frames to tell outliers apart
+            return
+        # sigma times the standard deviation, from (n * sumsq - sum^2) / n^2
+        np.multiply(self.sumsq, n, out=self.spread)
+        np.square(self.sum, out=self.squares, dtype=self.squares.dtype)
+        self.spread -= self.squares
+        self.spread *= self.sigma * self.sigma / (n * n)
+        np.sqrt(self.spread, out=self.spread)
+        # The range of pixel values that are kept, rounded inwards to integers
+        maxValue = np.iinfo(self.dtype).max
+        np.subtract(self.mean, self.spread, out=self.squares)
+        np.ceil(self.squares, out=self.squares)
+        np.clip(self.squares, 0, maxValue, out=self.squares)
+        np.copyto(self.low, self.squares, casting='unsafe')
+        np.add(self.mean, self.spread, out=self.squares)
+        np.floor(self.squares, out=self.squares)
+        np.clip(self.squares, 0, maxValue, out=self.squares)
+        np.copyto(self.high, self.squares, casting='unsafe')
+        self.total[...] = 0
+        self.kept[...] = 0
+        for f in self.frames[:n]:
+            np.greater_equal(f, self.low, out=self.inside)
+            np.less_equal(f, self.high, out=self.below)
+            self.inside &= self.below
+            np.add(self.total, f, out=self.total, where=self.inside)
+            self.kept += self.inside
+        # No frame is kept when the mean is rounded off just past a constant pixel, which then keeps the mean
+        np.divide(self.total, self.kept, out=self.mean, where=self.kept > 0)
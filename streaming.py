@@ -3,84 +3,678 @@ from io import BytesIO
 from datetime import datetime
 from os.path import join, exists
 from os import mkdir
-from threading import Condition, Thread
+from threading import Condition, Lock, Thread
 from http import server
+from urllib.parse import parse_qs, unquote, urlsplit
+from email.utils import formatdate
+from math import isfinite
 import socketserver
+import asyncio
 import json
 import logging
+from metrics import Metrics, clock, render
+from processing import downscale, encode_jpeg
 
 
-class StreamingOutput(object):
-    def __init__(self):
-        self.frame = None
-        self.buffer = BytesIO()
+# An encoded frame. The data is immutable so it can be shared by all clients without copying.
+class EncodedFrame(object):
+    def __init__(self, seq, timestamp, data):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.data = data
+
+
+# Publishes the latest frame to every consumer, both the MJPEG streams and the latest images.
+# Encoding is demand driven. A variant is a (downscale factor, JPEG quality) pair, and it is only encoded eagerly
+# while someone is streaming it or has asked for it recently. Other variants are encoded when requested,
+# so an idle camera doesn't spend any time on JPEG encoding. Encoded variants are cached per frame,
+# so any number of clients asking for the same variant cost one encode.
+class FrameBroker(object):
+    # Named variant -> downscale factor
+    VARIANTS = {'full': 1, 'preview': 2, 'thumb': 8}
+    SCALES = (1, 2, 4, 8)
+
+    def __init__(self, quality=90, idleTimeout=30, variants=None):
+        self.quality = quality
+        self.idleTimeout = idleTimeout  # Seconds a variant stays active after it was last requested
+        self.variants = dict(variants if variants is not None else self.VARIANTS)
+        self.raw = None  # The latest unencoded pipeline.Frame, kept for encoding on demand
+        self.frames = {}  # Variant -> EncodedFrame of the latest frame
+        self.seq = 0
+        self.epoch = int(time())
+        # Time of the last capture, used to know the camera has stopped responding
+        self.lastUpdate = time()
         self.condition = Condition()
+        self.subscribers = {}
+        self.lastRequested = {}
+        self.encodeLocks = {}
+        # Callbacks invoked with every new frame from the producer thread. They must not block.
+        self.listeners = []
+        # Shared by every stage of the pipeline that feeds this broker
+        self.metrics = Metrics()
+
+    # Returns the variant key of a named variant, optionally overriding its scale (a fraction of the full size)
+    # and quality. They are snapped to a few steps, so that similar requests share the same cached encode.
+    def variant(self, name='full', scale=None, quality=None):
+        factor = self.variants[name]
+        if scale is not None and scale > 0:
+            factor = min(self.SCALES, key=lambda s: abs(s - 1 / scale))
+        quality = self.quality if quality is None else min(95, max(10, int(round(quality / 5.0)) * 5))
+        return (factor, quality)
+
+    # Streaming clients subscribe to a variant for as long as they are connected
+    def subscribe(self, variant):
+        with self.condition:
+            self.subscribers[variant] = self.subscribers.get(variant, 0) + 1
+
+    def unsubscribe(self, variant):
+        with self.condition:
+            self.subscribers[variant] -= 1
+
+    def active_variants(self):
+        now = time()
+        with self.condition:
+            return [variant for variant in set(self.subscribers) | set(self.lastRequested)
+                    if self.subscribers.get(variant, 0) > 0 or now < self.lastRequested.get(variant, 0) + self.idleTimeout]
 
-    def write(self, buf):
-        if buf.startswith(b'\xff\xd8'):
-            # New frame, copy the existing buffer's content and notify all
-            # clients it's available
-            self.buffer.truncate()
+    # encoded optionally maps variants to JPEG data that has been encoded elsewhere, e.g. by an EncoderPool
+    def publish_frame(self, frame, encoded=None):
+        start = clock()
+        frame.retain()
+        with self.condition:
+            old = self.raw
+            self.seq += 1
+            frame.seq = self.seq
+            self.raw = frame
+            self.frames = {variant: EncodedFrame(frame.seq, frame.timestamp, data) for variant, data in (encoded or {}).items()}
+        if old is not None:
+            old.release()
+        if encoded is None:
+            # Encode the variants in demand right away, in the producer thread, so waiting clients find them ready
+            for variant in self.active_variants():
+                self.encode(variant, frame)
+        with self.condition:
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener(frame)
+        self.metrics.observe_since('publish', start)
+
+    def encode(self, variant, frame):
+        with self.condition:
+            lock = self.encodeLocks.setdefault(variant, Lock())
+        with lock:
+            with self.condition:
+                encoded = self.frames.get(variant) if self.raw is frame else None
+            if encoded is not None:
+                return encoded
+            start = clock()
+            factor, quality = variant
+            img = downscale(frame.img, factor)
+            encoded = EncodedFrame(frame.seq, frame.timestamp, encode_jpeg(img, quality, frame.bgr))
+            self.metrics.observe_since('encode', start)
             with self.condition:
-                self.frame = self.buffer.getvalue()
-                self.condition.notify_all()
-            self.buffer.seek(0)
-        return self.buffer.write(buf)
+                if self.raw is frame:
+                    self.frames[variant] = encoded
+        return encoded
+
+    # The latest frame if it has been encoded already, without encoding it
+    def cached(self, variant):
+        with self.condition:
+            return self.frames.get(variant)
+
+    # The latest frame of the variant, encoded on demand. Returns None before the first frame.
+    # Unless track is False, the variant is kept encoded eagerly for a while.
+    def get(self, variant, track=True):
+        if track:
+            self.lastRequested[variant] = time()
+        with self.condition:
+            encoded = self.frames.get(variant)
+            frame = self.raw.retain() if encoded is None and self.raw is not None else None
+        if frame is None:
+            return encoded
+        try:
+            return self.encode(variant, frame)
+        finally:
+            frame.release()
+
+    # Blocks until a frame newer than seq is available. Returns None on timeout.
+    def wait(self, seq, variant, timeout=None, track=True):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq > seq, timeout):
+                return None
+        return self.get(variant, track)
+
+
+# Parses the stream parameters of a query string: fps, quality and scale, e.g. ?fps=5&scale=0.5&quality=60
+# Returns (fps, scale, quality), None for the ones that aren't given.
+def parse_stream_params(query):
+    params = parse_qs(query)
+    def number(name):
+        try:
+            value = float(params[name][0])
+        except (KeyError, ValueError):
+            return None
+        # nan and inf are ignored like missing parameters
+        return value if isfinite(value) else None
+    return number('fps'), number('scale'), number('quality')
+
+# Parses the long poll parameters of a query string, e.g. ?after=1234&timeout=30
+# Returns (after, timeout). after is None if not given, the timeout is capped at maxTimeout seconds.
+def parse_poll_params(query, maxTimeout=60):
+    params = parse_qs(query)
+    try:
+        after = int(params['after'][0])
+    except (KeyError, ValueError):
+        after = None
+    try:
+        timeout = min(maxTimeout, max(0.0, float(params['timeout'][0])))
+    except (KeyError, ValueError):
+        timeout = maxTimeout / 2
+    return after, timeout
+
+
+# Validators of an encoded frame. The sequence number identifies the frame, and the epoch tells apart
+# the sequence numbers of different runs.
+def frame_headers(broker, frame, variant):
+    return [
+        ('ETag', '"%d-%d-%d-%d"' % (broker.epoch, frame.seq, variant[0], variant[1])),
+        ('Last-Modified', formatdate(frame.timestamp, usegmt=True)),
+        ('X-Frame-Seq', str(frame.seq)),
+    ]
+
+
+# Whether an If-None-Match header matches the ETag: a list of tags, weak or not, or *
+def etag_matches(ifNoneMatch, etag):
+    if not ifNoneMatch:
+        return False
+    for tag in ifNoneMatch.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+# Paced clients are due on a common time grid, so that clients with the same frame rate
+# ask for the same frame and share its encode
+def next_due(fps):
+    return (int(time() * fps) + 1) / fps
+
+
+# Path -> output variant
+STREAM_ROUTES = {'/stream.mjpg': 'full', '/stream_preview.mjpg': 'preview'}
+LATEST_ROUTES = {'/latest.jpg': 'preview', '/latest_full.jpg': 'full', '/latest_thumb.jpg': 'thumb'}
+
+
+# Camera id -> broker. A single broker serves as camera '0'.
+def camera_brokers(broker):
+    return dict(broker) if isinstance(broker, dict) else {'0': broker}
+
+
+# Splits /cam/<id>/stream.mjpg into the camera id and the route. Paths without /cam/<id> have no camera id.
+def split_camera(path):
+    if not path.startswith('/cam/'):
+        return None, path
+    camera, _, route = path[len('/cam/'):].partition('/')
+    return unquote(camera), '/' + route
+
+
+# The metrics of every camera, labelled with the camera id when there is more than one
+def metrics_sources(brokers):
+    if len(brokers) == 1:
+        return [({}, broker.metrics) for broker in brokers.values()]
+    return [({'camera': camera}, broker.metrics) for camera, broker in brokers.items()]
+
 
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
 
-    def __init__(self, address, handler, output_stream, latest_stream):
+    # broker is the FrameBroker of the camera, or a dict of camera id -> FrameBroker to serve several cameras
+    # at /cam/<id>/. The first one is also served at the routes without /cam/<id>.
+    def __init__(self, address, handler, broker):
         super(StreamingServer, self).__init__(address, handler)
-        self.output_stream = output_stream
-        self.latest_stream = latest_stream
-        # Used for invokers to know the camera has stopped responding
-        self.last_update_timestamp = time()
+        self.brokers = camera_brokers(broker)
+        self.camera = next(iter(self.brokers))
+        self.broker = self.brokers[self.camera]
+        self.clients = {camera: 0 for camera in self.brokers}
+        self.clientsLock = Lock()
+        for camera, broker in self.brokers.items():
+            broker.metrics.register('stream_clients', 'gauge', 'Connected streaming clients.',
+                                    lambda camera=camera: self.clients[camera])
+            broker.metrics.describe('bytes_sent_total', 'Bytes of JPEG data sent to clients.')
+        self.recorder = None  # Optional hook for serving the recordings of a recorder.Recorder
+        self.motion = None  # Optional hook for serving the events of a motion.MotionDetector
+        self.products = None  # Optional hook for serving the keogram and time-lapse of an allsky.AllSkyProducts
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
     def do_GET(self):
-        if self.path == '/':
+        url = urlsplit(self.path)
+        camera, path = split_camera(url.path)
+        routed = camera is not None
+        if not routed:
+            camera = self.server.camera
+        broker = self.server.brokers.get(camera)
+        fps, scale, quality = parse_stream_params(url.query)
+        # Only the streams and latest images are served per camera
+        if broker is None or (routed and path not in STREAM_ROUTES and path not in LATEST_ROUTES):
+            self.send_error(404)
+            self.end_headers()
+        elif path == '/':
             self.send_response(301)
             self.send_header('Location', '/stream.mjpg')
             self.end_headers()
-        elif self.path == '/stream.mjpg':
+        elif path in STREAM_ROUTES:
+            variant = broker.variant(STREAM_ROUTES[path], scale, quality)
+            # A client with a frame rate limit only gets frames encoded when it is due,
+            # instead of keeping its variant encoded for every frame
+            paced = fps is not None and fps > 0
             self.send_response(200)
             self.send_header('Age', 0)
             self.send_header('Cache-Control', 'no-cache, private')
             self.send_header('Pragma', 'no-cache')
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
+            if not paced:
+                broker.subscribe(variant)
+            with self.server.clientsLock:
+                self.server.clients[camera] += 1
             try:
+                seq = broker.seq
+                due = 0
                 while True:
-                    with self.server.output_stream.condition:
-                        self.server.output_stream.condition.wait()
-                        frame = self.server.output_stream.frame
+                    if paced:
+                        # due can pass between two reads of the clock
+                        sleep(max(0, due - time()))
+                    frame = broker.wait(seq, variant, track=not paced)
+                    if frame is None:
+                        continue
+                    seq = frame.seq
+                    if paced:
+                        due = next_due(fps)
                     self.wfile.write(b'--FRAME\r\n')
                     self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
+                    self.send_header('Content-Length', len(frame.data))
                     self.end_headers()
-                    self.wfile.write(frame)
+                    self.wfile.write(frame.data)
                     self.wfile.write(b'\r\n')
+                    broker.metrics.count('bytes_sent_total', len(frame.data))
             except Exception as e:
                 logging.warning(
                     'Removed streaming client %s: %s',
                     self.client_address, str(e))
-        elif self.path == '/latest.jpg' or self.path == '/latest_full.jpg':
-            if self.server.last_update_timestamp is not None and time() > self.server.last_update_timestamp + 20:
+            finally:
+                with self.server.clientsLock:
+                    self.server.clients[camera] -= 1
+                if not paced:
+                    broker.unsubscribe(variant)
+        elif path in LATEST_ROUTES:
+            variant = broker.variant(LATEST_ROUTES[path], scale, quality)
+            after, timeout = parse_poll_params(url.query)
+            if after is not None and after > broker.seq:
+                # From before a restart, which started the sequence numbers again. The client gets the current frame.
+                after = None
+            if time() > broker.lastUpdate + 20:
                 # hasn't been updated in 20 seconds, begin returning 404
+                frame = None
+            elif after is not None and broker.seq <= after:
+                # Long poll: wait for a frame newer than the one the client has
+                frame = broker.wait(after, variant, timeout) or broker.get(variant)
+            else:
+                frame = broker.get(variant)
+            if frame is None:
                 self.send_error(404)
                 self.end_headers()
-            else:
+                return
+            headers = frame_headers(broker, frame, variant)
+            # Nothing newer than what the client has, either from a long poll that timed out or a conditional GET
+            modified = (after is None or frame.seq > after) and not etag_matches(self.headers.get('If-None-Match'), headers[0][1])
+            if modified:
                 self.send_response(200)
                 self.send_header('Age', 0)
-                self.send_header('Cache-Control', 'no-cache, private')
-                self.send_header('Pragma', 'no-cache')
-                frame = self.server.latest_stream.frame
                 self.send_header('Content-Type', 'image/jpeg')
-                self.send_header('Content-Length', len(frame))
+                self.send_header('Content-Length', len(frame.data))
+            else:
+                self.send_response(304)
+            self.send_header('Cache-Control', 'no-cache, private')
+            self.send_header('Pragma', 'no-cache')
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            if modified:
+                self.wfile.write(frame.data)
+                broker.metrics.count('bytes_sent_total', len(frame.data))
+        elif path == '/cameras':
+            body = json.dumps(list(self.server.brokers)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(body))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/metrics':
+            body = render(metrics_sources(self.server.brokers)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', len(body))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/motion' and self.server.motion is not None:
+            # The recent motion events, only the ones after a given event id with ?after=
+            try:
+                after = int(parse_qs(url.query)['after'][0])
+            except (KeyError, ValueError):
+                after = 0
+            body = json.dumps({'events': self.server.motion.recent(after)}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Cache-Control', 'no-cache, private')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(body))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/keogram.jpg' and self.server.products is not None:
+            data = self.server.products.keogram_jpeg(int(quality) if quality is not None else 90)
+            if data is None:
+                self.send_error(404)
                 self.end_headers()
-                self.wfile.write(frame)
+                return
+            self.send_response(200)
+            self.send_header('Cache-Control', 'no-cache, private')
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', len(data))
+            self.end_headers()
+            self.wfile.write(data)
+        elif path == '/timelapse.mjpg' and self.server.products is not None:
+            # Plays the time-lapse of the night so far once, at 10 fps by default
+            interval = 1.0 / (fps if fps is not None and fps > 0 else 10)
+            self.send_response(200)
+            self.send_header('Age', 0)
+            self.send_header('Cache-Control', 'no-cache, private')
+            self.send_header('Pragma', 'no-cache')
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+            self.end_headers()
+            try:
+                for _, data in self.server.products.timelapse.frames:
+                    self.wfile.write(b'--FRAME\r\n')
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', len(data))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    self.wfile.write(b'\r\n')
+                    sleep(interval)
+            except Exception as e:
+                logging.warning(
+                    'Removed time-lapse client %s: %s',
+                    self.client_address, str(e))
+        elif path.startswith('/recordings') and self.server.recorder is not None:
+            self.do_recordings(path, parse_qs(url.query))
+        else:
+            self.send_error(404)
+            self.end_headers()
+
+    # /recordings lists the segments, /recordings/frame.jpg?t= returns the frame recorded at a time,
+    # /recordings/playback.mjpg?start=&end=&speed= plays a time range back, and /recordings/trigger saves an event
+    def do_recordings(self, path, params):
+        recorder = self.server.recorder
+        def number(name, default=None):
+            try:
+                return float(params[name][0])
+            except (KeyError, ValueError):
+                return default
+        if path == '/recordings':
+            body = json.dumps(recorder.list()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(body))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/recordings/trigger':
+            recorder.trigger(number('seconds'))
+            self.send_response(204)
+            self.end_headers()
+        elif path == '/recordings/frame.jpg':
+            found = recorder.frame_at(number('t', time()))
+            if found is None:
+                self.send_error(404)
+                self.end_headers()
+                return
+            timestamp, data = found
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', len(data))
+            self.send_header('Last-Modified', formatdate(timestamp, usegmt=True))
+            self.end_headers()
+            self.wfile.write(data)
+        elif path == '/recordings/playback.mjpg':
+            end = number('end', time())
+            start = number('start', end - 60)
+            # Relative to the recorded pace, 0 plays back as fast as the client reads
+            speed = number('speed', 1)
+            self.send_response(200)
+            self.send_header('Age', 0)
+            self.send_header('Cache-Control', 'no-cache, private')
+            self.send_header('Pragma', 'no-cache')
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+            self.end_headers()
+            try:
+                began = None
+                for timestamp, data in recorder.frames(start, end):
+                    if began is None:
+                        began = (time(), timestamp)
+                    elif speed > 0:
+                        sleep(max(0, began[0] + (timestamp - began[1]) / speed - time()))
+                    self.wfile.write(b'--FRAME\r\n')
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', len(data))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    self.wfile.write(b'\r\n')
+            except Exception as e:
+                logging.warning(
+                    'Removed playback client %s: %s',
+                    self.client_address, str(e))
         else:
             self.send_error(404)
             self.end_headers()
+
+
+# A single threaded server based on asyncio, for many concurrent clients.
+# Unlike StreamingServer, clients don't get their own threads competing for the GIL with the camera.
+# A client that can't keep up skips frames: it always gets the newest frame once its socket drains.
+class AsyncStreamingServer(object):
+    # broker is a FrameBroker, or a dict of camera id -> FrameBroker as for StreamingServer
+    def __init__(self, address, broker):
+        self.address = address
+        self.brokers = camera_brokers(broker)
+        self.camera = next(iter(self.brokers))
+        self.broker = self.brokers[self.camera]
+        self.loop = None
+        self.frame_events = {}  # Camera id -> event set when its next frame is published
+        self.clients = {camera: set() for camera in self.brokers}
+        self.write_buffer_limit = 256 * 1024
+        self.motion = None  # Optional hook for serving the events of a motion.MotionDetector
+        self.products = None  # Optional hook for serving the keogram and time-lapse of an allsky.AllSkyProducts
+        for camera, broker in self.brokers.items():
+            broker.metrics.register('stream_clients', 'gauge', 'Connected streaming clients.',
+                                    lambda camera=camera: len(self.clients[camera]))
+            broker.metrics.describe('bytes_sent_total', 'Bytes of JPEG data sent to clients.')
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        listeners = {}
+        for camera, broker in self.brokers.items():
+            self.frame_events[camera] = asyncio.Event()
+            listeners[camera] = lambda frame, camera=camera: self.on_frame(camera)
+            broker.listeners.append(listeners[camera])
+        try:
+            host, port = self.address
+            srv = await asyncio.start_server(self.handle, host or None, port, reuse_address=True)
+            async with srv:
+                await srv.serve_forever()
+        finally:
+            for camera, listener in listeners.items():
+                self.brokers[camera].listeners.remove(listener)
+
+    # Called from the producer thread. Only schedules a wake up, so it never stalls the producer.
+    def on_frame(self, camera):
+        self.loop.call_soon_threadsafe(self.wake_clients, camera)
+
+    # Only the clients of the camera that published wake up
+    def wake_clients(self, camera):
+        event, self.frame_events[camera] = self.frame_events[camera], asyncio.Event()
+        event.set()
+
+    async def next_frame(self, camera, seq, variant, track=True):
+        broker = self.brokers[camera]
+        while broker.seq <= seq:
+            await self.frame_events[camera].wait()
+        return await self.get(broker, variant, track)
+
+    # Variants nobody has asked for yet are encoded on demand, which must not block the event loop
+    async def get(self, broker, variant, track=True):
+        frame = broker.cached(variant)
+        if frame is not None and frame.seq == broker.seq:
+            if track:
+                broker.lastRequested[variant] = time()
+            return frame
+        return await self.loop.run_in_executor(None, broker.get, variant, track)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            lines = request.decode('latin-1').split('\r\n')
+            url = urlsplit(lines[0].split(' ')[1])
+            headers = dict((name.strip().lower(), value.strip()) for name, _, value in
+                           (line.partition(':') for line in lines[1:] if line))
+        except Exception:
+            writer.close()
+            return
+        camera, path = split_camera(url.path)
+        routed = camera is not None
+        if not routed:
+            camera = self.camera
+        broker = self.brokers.get(camera)
+        fps, scale, quality = parse_stream_params(url.query)
+        writer.transport.set_write_buffer_limits(high=self.write_buffer_limit)
+        try:
+            if broker is None or (routed and path not in STREAM_ROUTES and path not in LATEST_ROUTES):
+                writer.write(b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            elif path == '/':
+                writer.write(b'HTTP/1.0 301 Moved Permanently\r\nLocation: /stream.mjpg\r\n\r\n')
+            elif path in STREAM_ROUTES:
+                await self.stream(writer, camera, broker.variant(STREAM_ROUTES[path], scale, quality), fps)
+            elif path in LATEST_ROUTES:
+                await self.latest(writer, camera, broker.variant(LATEST_ROUTES[path], scale, quality),
+                                  parse_poll_params(url.query), headers.get('if-none-match'))
+            elif path == '/cameras':
+                body = json.dumps(list(self.brokers)).encode('utf-8')
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' % len(body))
+                writer.write(body)
+            elif path == '/metrics':
+                body = render(metrics_sources(self.brokers)).encode('utf-8')
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n' % len(body))
+                writer.write(body)
+            elif path == '/motion' and self.motion is not None:
+                # The recent motion events, only the ones after a given event id with ?after=
+                try:
+                    after = int(parse_qs(url.query)['after'][0])
+                except (KeyError, ValueError):
+                    after = 0
+                body = json.dumps({'events': self.motion.recent(after)}).encode('utf-8')
+                writer.write(b'HTTP/1.0 200 OK\r\nCache-Control: no-cache, private\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: %d\r\n\r\n' % len(body))
+                writer.write(body)
+            elif path == '/keogram.jpg' and self.products is not None:
+                # Encoded in a thread, when the keogram has grown
+                data = await self.loop.run_in_executor(None, self.products.keogram_jpeg,
+                                                       int(quality) if quality is not None else 90)
+                if data is None:
+                    writer.write(b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                else:
+                    writer.write(b'HTTP/1.0 200 OK\r\nCache-Control: no-cache, private\r\nContent-Type: image/jpeg\r\n'
+                                 b'Content-Length: %d\r\n\r\n' % len(data))
+                    writer.write(data)
+            elif path == '/timelapse.mjpg' and self.products is not None:
+                # Plays the time-lapse of the night so far once, at 10 fps by default
+                interval = 1.0 / (fps if fps is not None and fps > 0 else 10)
+                writer.write(b'HTTP/1.0 200 OK\r\nAge: 0\r\nCache-Control: no-cache, private\r\nPragma: no-cache\r\n'
+                             b'Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n\r\n')
+                for _, data in self.products.timelapse.frames:
+                    writer.write(b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(data))
+                    writer.write(data)
+                    writer.write(b'\r\n')
+                    await writer.drain()
+                    await asyncio.sleep(interval)
+            else:
+                writer.write(b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+        except Exception as e:
+            logging.warning('Removed streaming client %s: %s', writer.get_extra_info('peername'), str(e))
+        finally:
+            writer.close()
+
+    async def latest(self, writer, camera, variant, poll, ifNoneMatch):
+        broker = self.brokers[camera]
+        after, timeout = poll
+        if after is not None and after > broker.seq:
+            # From before a restart, which started the sequence numbers again. The client gets the current frame.
+            after = None
+        if time() > broker.lastUpdate + 20:
+            # hasn't been updated in 20 seconds, begin returning 404
+            frame = None
+        elif after is not None and broker.seq <= after:
+            # Long poll: wait for a frame newer than the one the client has
+            try:
+                frame = await asyncio.wait_for(self.next_frame(camera, after, variant), timeout)
+            except asyncio.TimeoutError:
+                frame = await self.get(broker, variant)
+        else:
+            frame = await self.get(broker, variant)
+        if frame is None:
+            writer.write(b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            return
+        headers = frame_headers(broker, frame, variant)
+        # Nothing newer than what the client has, either from a long poll that timed out or a conditional GET
+        modified = (after is None or frame.seq > after) and not etag_matches(ifNoneMatch, headers[0][1])
+        headers = ''.join('%s: %s\r\n' % header for header in headers).encode('latin-1')
+        if modified:
+            writer.write(b'HTTP/1.0 200 OK\r\nAge: 0\r\nCache-Control: no-cache, private\r\nPragma: no-cache\r\n' + headers +
+                         b'Content-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame.data))
+            writer.write(frame.data)
+            broker.metrics.count('bytes_sent_total', len(frame.data))
+        else:
+            writer.write(b'HTTP/1.0 304 Not Modified\r\nCache-Control: no-cache, private\r\nPragma: no-cache\r\n' + headers + b'\r\n')
+
+    async def stream(self, writer, camera, variant, fps=None):
+        broker = self.brokers[camera]
+        writer.write(b'HTTP/1.0 200 OK\r\nAge: 0\r\nCache-Control: no-cache, private\r\nPragma: no-cache\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n\r\n')
+        # A client with a frame rate limit only gets frames encoded when it is due
+        paced = fps is not None and fps > 0
+        self.clients[camera].add(writer)
+        if not paced:
+            broker.subscribe(variant)
+        try:
+            seq = broker.seq
+            while True:
+                frame = await self.next_frame(camera, seq, variant, track=not paced)
+                if frame is None:
+                    continue
+                seq = frame.seq
+                writer.write(b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame.data))
+                writer.write(frame.data)
+                writer.write(b'\r\n')
+                broker.metrics.count('bytes_sent_total', len(frame.data))
+                # Only this client waits here. Frames published in the meantime are skipped for it.
+                await writer.drain()
+                if paced:
+                    await asyncio.sleep(max(0, next_due(fps) - time()))
+        finally:
+            if not paced:
+                broker.unsubscribe(variant)
+            self.clients[camera].discard(writer)
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from math import asinh, exp, log
+from threading import Lock
+import numpy as np
+
+
+# Tone curves on normalized values in [0, 1], vectorized over numpy arrays.
+def gamma_curve(x, gamma):
+    return np.power(x, gamma)
+
+def asinh_curve(x, beta):
+    return np.arcsinh(beta * x) / asinh(beta)
+
+# The midtones transfer function used by astronomy stretch tools. m is the midtones balance.
+def mtf_curve(x, m):
+    return (m - 1) * x / ((2 * m - 1) * x - m)
+
+
+# Picks the curve parameter that maps the normalized mean x0 to the normalized target y0
+def gamma_param(x0, y0):
+    return log(y0) / log(x0)
+
+def asinh_param(x0, y0):
+    # asinh(b * x0) / asinh(b) grows with b, so bisect in log space
+    low, high = -10.0, 20.0
+    for _ in range(40):
+        mid = (low + high) / 2
+        beta = exp(mid)
+        if asinh(beta * x0) / asinh(beta) < y0:
+            low = mid
+        else:
+            high = mid
+    return exp((low + high) / 2)
+
+def mtf_param(x0, y0):
+    return (y0 - 1) * x0 / ((2 * y0 - 1) * x0 - y0)
+
+
+CURVES = {
+    'gamma': (gamma_curve, gamma_param),
+    'asinh': (asinh_curve, asinh_param),
+    'mtf': (mtf_curve, mtf_param),
+}
+
+
+# Builds lookup tables for tone curves and applies them in place.
+# A LUT has one entry per input value (256 for RAW8, 65536 for RAW16), so the per pixel cost is a single table
+# lookup instead of a transcendental function. LUTs are kept in a small LRU cache keyed by the quantized parameter.
+class ToneMapper(object):
+    def __init__(self, cacheSize=16, quantization=0.01):
+        self.cacheSize = cacheSize
+        self.quantization = quantization  # Relative step of the curve parameter between cached LUTs
+        self.luts = OrderedDict()
+        self.lock = Lock()
+
+    def get_lut(self, curve, param, dtype=np.uint8, out_dtype=None):
+        dtype = np.dtype(dtype)
+        out_dtype = dtype if out_dtype is None else np.dtype(out_dtype)
+        # Quantize the parameter so that slowly drifting brightness reuses the same LUT
+        step = int(round(log(param) / self.quantization))
+        key = (curve, step, dtype.str, out_dtype.str)
+        with self.lock:
+            lut = self.luts.get(key)
+            if lut is not None:
+                self.luts.move_to_end(key)
+                return lut
+        lut = self.build_lut(curve, exp(step * self.quantization), dtype, out_dtype)
+        with self.lock:
+            self.luts[key] = lut
+            while len(self.luts) > self.cacheSize:
+                self.luts.popitem(last=False)
+        return lut
+
+    @staticmethod
+    def build_lut(curve, param, dtype, out_dtype):
+        in_max = np.iinfo(dtype).max
+        out_max = np.iinfo(out_dtype).max
+        x = np.arange(in_max + 1, dtype=np.float64) / in_max
+        y = np.clip(CURVES[curve][0](x, param), 0, 1)
+        lut = np.rint(y * out_max).astype(out_dtype)
+        lut.flags.writeable = False
+        return lut
+
+    # The LUT that maps mean to target, both in the units of dtype, optionally converting to out_dtype
+    def stretch_lut(self, dtype, mean, target, curve='gamma', out_dtype=None):
+        in_max = np.iinfo(dtype).max
+        x0 = min(max(mean / in_max, 1 / in_max), 1 - 1 / in_max)
+        y0 = min(max(target / in_max, 1 / in_max), 1 - 1 / in_max)
+        param = CURVES[curve][1](x0, y0)
+        return self.get_lut(curve, param, dtype, out_dtype)
+
+    # Stretch arr in place so that its mean maps to target. Both are in the units of arr.
+    def stretch(self, arr, mean, target, curve='gamma'):
+        self.apply(arr, self.stretch_lut(arr.dtype, mean, target, curve))
+        return arr
+
+    @staticmethod
+    def apply(arr, lut, out=None):
+        if out is None:
+            out = arr
+        return np.take(lut, arr, out=out, mode='clip')